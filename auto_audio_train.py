@@ -19,6 +19,8 @@ from typing import Optional, List, Dict, Any
 from dotenv import load_dotenv
 import requests
 
+from workflow_tester_base import mount_http_adapter
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 log = logging.getLogger(__name__)
 
@@ -506,6 +508,7 @@ class TrainingClient:
         self.llm_api_key = os.getenv("LLM_API_KEY", "")
         self.llm_model = os.getenv("LLM_MODEL", "Doubao-1.5-pro-32k")
         self.llm_service_code = os.getenv("LLM_SERVICE_CODE", "SI_Ability")
+        self.llm_session = mount_http_adapter(requests.Session())
 
         # 对话历史（用于提供上下文）
         self.conversation_history = []
@@ -862,7 +865,7 @@ class TrainingClient:
         }
 
         try:
-            response = requests.post(
+            response = self.llm_session.post(
                 self.llm_api_url,
                 headers=headers,
                 json=payload,
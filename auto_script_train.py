@@ -1,15 +1,82 @@
 import requests
-import json
 import time
 import os
 import difflib
-import math
+import functools
+import hashlib
+import io
+import logging
 import re
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from openai import OpenAI
-from typing import Optional, List, Dict
-from workflow_tester_base import WorkflowTesterBase
+import numpy as np
+from urllib3.util.retry import Retry
+from typing import Optional, List, Dict, Tuple
+from workflow_tester_base import WorkflowTesterBase, _dumps, _env, _loads, mount_http_adapter
+
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:  # 未安装 rapidfuzz 时回退到 difflib
+    fuzz = None
+    process = None
+
+_faiss_module = None  # 首次构建回放索引时才导入 faiss（较重），False 表示未安装
+
+
+def _optional_faiss():
+    """Import faiss on first use; returns None when it is not installed (numpy fallback)."""
+    global _faiss_module
+    if _faiss_module is None:
+        try:
+            import faiss
+        except ImportError:
+            faiss = False
+        _faiss_module = faiss
+    return _faiss_module or None
+
+
+# 对话循环中的状态输出走 logging，LOG_LEVEL=DEBUG 时显示调用细节，WARNING 时仅保留告警
+log = logging.getLogger(__name__)
+if not log.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(_log_handler)
+    log.propagate = False
+log.setLevel(logging.INFO)  # LOG_LEVEL 在 WorkflowTester 初始化（已加载 .env）后生效
+
+# 问题归一化：去掉 think 标签，并截取最后一个以问号结尾的句子
+_THINK_RE = re.compile(r"</?think[^>]*>")
+_Q_RE = re.compile(r"[^。！？\n\r]*[？\?]")
+# 对话日志块头部，一次匹配取出时间戳 / step_id / 轮次 / 来源
+# 新格式: [时间] Step: 步骤名称 | step_id: xxx | 第 1 轮 | 来源: chat
+# 旧格式: [时间] Step xxx | 第 1 轮 | 来源: chat
+_HEADER_RE = re.compile(
+    r"^(?:\[(?P<ts>[^\]]*)\])?\s*"
+    r"(?:Step:.*?\|\s*step_id:\s*(?P<sid_new>.*?)|Step\s+(?P<sid_old>[^|]*?))?"
+    r"\s*(?:\|\s*第\s*(?P<round>\d+)\s*轮)?"
+    r"\s*(?:\|\s*来源:\s*(?P<src>.*?))?\s*$"
+)
+
+# 封闭式问题（确认式/选择式）的规则表：命中时直接给出固定回答，不再调用大模型
+_CLOSED_FORM_RULES = (
+    (re.compile(r"请(?:回复|回答)\s*[「“\"']?是[」”\"']?\s*(?:或|还是|/)\s*[「“\"']?否"), "是"),
+    (re.compile(r"(?:确认|同意|准备好)[^。！？\n]*请回复\s*[「“\"']?(是|好的|确认)[」”\"']?\s*[。！!]?\s*$"),
+     lambda m: m.group(1)),
+    (re.compile(r"请选择\s*[（(]?([A-Da-d1-9])[）)]?\s*(?:[/、，,或]\s*[（(]?[A-Da-d1-9][）)]?\s*)+"),
+     lambda m: f"我选择{m.group(1).upper()}"),
+)
+
+
+def _closed_form_answer(question: str) -> Optional[str]:
+    """按规则表识别封闭式问题，命中返回固定回答，否则返回 None"""
+    for pattern, answer in _CLOSED_FORM_RULES:
+        m = pattern.search(question)
+        if m:
+            return answer(m) if callable(answer) else answer
+    return None
 
 
 class DialogueEntry:
@@ -44,32 +111,37 @@ class DialogueLogParser:
             解析后的对话条目列表
         """
         entries = []
+        separator = '-' * 80
 
+        # 逐行流式读取，遇到分隔线即解析一个对话块；文本模式已统一 \r\n / \r 换行
         try:
-            with open(log_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            with open(log_path, 'r', encoding='utf-8', buffering=1 << 20) as f:
+                current_block: List[str] = []
+                for line in f:
+                    if line.rstrip() == separator:
+                        DialogueLogParser._flush_block(current_block, entries)
+                        current_block = []
+                    else:
+                        current_block.append(line)
+                DialogueLogParser._flush_block(current_block, entries)
         except Exception as e:
             print(f"❌ 读取日志文件失败: {str(e)}")
             return entries
 
-        # 按分隔符分割对话块（处理可能的换行符差异）
-        separator = '-' * 80
-        # 替换所有可能的分隔符变体为统一格式
-        normalized_content = content.replace(separator + '\r\n', separator + '\n')
-        normalized_content = normalized_content.replace(separator + '\r', separator + '\n')
-        blocks = normalized_content.split(separator + '\n')
-
-        for block in blocks:
-            if not block.strip():
-                continue
-
-            entry = DialogueLogParser._parse_block(block)
-            if entry:
-                entries.append(entry)
-
         print(f"✅ 解析日志文件完成，共 {len(entries)} 个对话条目")
         return entries
 
+    @staticmethod
+    def _flush_block(lines: List[str], entries: List[DialogueEntry]):
+        """解析累积的对话块行，有效条目追加到 entries"""
+        block = ''.join(lines)
+        if not block.strip():
+            return
+
+        entry = DialogueLogParser._parse_block(block)
+        if entry:
+            entries.append(entry)
+
     @staticmethod
     def _parse_block(block: str) -> Optional[DialogueEntry]:
         """解析单个对话块"""
@@ -106,57 +178,19 @@ class DialogueLogParser:
         """解析头部信息"""
         # 新格式: [2025-11-28 16:01:21] Step: 步骤名称 | step_id: GnxX4RzREzTrXNmRGxq0 | 第 1 轮 | 来源: chat
         # 旧格式: [2025-11-28 16:01:21] Step GnxX4RzREzTrXNmRGxq0 | 第 1 轮 | 来源: chat
-        timestamp = ""
-        step_id = ""
-        round_num = None
-        source = "chat"
-
-        try:
-            # 提取时间戳
-            if header.startswith('['):
-                end_idx = header.find(']')
-                if end_idx > 0:
-                    timestamp = header[1:end_idx].strip()
-
-            # 优先尝试新格式：提取 step_id: xxx
-            step_id_marker = 'step_id: '
-            step_id_start = header.find(step_id_marker)
-            if step_id_start > 0:
-                # 新格式
-                step_id_value_start = step_id_start + len(step_id_marker)
-                step_id_end = header.find(' |', step_id_value_start)
-                if step_id_end > 0:
-                    step_id = header[step_id_value_start:step_id_end].strip()
-                else:
-                    # step_id 可能在末尾
-                    step_id = header[step_id_value_start:].strip()
-            else:
-                # 兼容旧格式：Step xxx |
-                step_start = header.find('Step ')
-                if step_start > 0:
-                    step_end = header.find(' |', step_start)
-                    if step_end > 0:
-                        step_id = header[step_start + 5:step_end].strip()
-
-            # 提取轮次
-            round_start = header.find('第 ')
-            if round_start > 0:
-                round_end = header.find(' 轮', round_start)
-                if round_end > 0:
-                    round_str = header[round_start + 2:round_end].strip()
-                    try:
-                        round_num = int(round_str)
-                    except ValueError:
-                        round_num = None
-
-            # 提取来源
-            source_start = header.find('来源: ')
-            if source_start > 0:
-                source = header[source_start + 4:].strip()
-        except Exception as e:
-            print(f"⚠️  解析头部信息失败: {header}, 错误: {str(e)}")
-
-        return timestamp, step_id, round_num, source
+        m = _HEADER_RE.match(header)
+        if not m:
+            # 文件头等非对话块没有头部字段，按默认值处理
+            return "", "", None, "chat"
+
+        step_id = m.group("sid_new")
+        if step_id is None:
+            step_id = m.group("sid_old") or ""
+        round_num = int(m.group("round")) if m.group("round") else None
+        source = m.group("src")
+        if source is None:
+            source = "chat"
+        return (m.group("ts") or "").strip(), step_id.strip(), round_num, source.strip()
 
     @staticmethod
     def extract_dialogue_pairs(entries: List[DialogueEntry]) -> List[Dict]:
@@ -174,6 +208,8 @@ class DialogueLogParser:
         pairs: List[Dict] = []
         last_ai_text: Optional[str] = None
         last_ai_meta: Dict = {}
+        # 重复出现的 AI 文本（开场白等）共用同一个字符串对象
+        interned: Dict[str, str] = {}
 
         for entry in entries:
             if entry.user_text and last_ai_text:
@@ -186,7 +222,7 @@ class DialogueLogParser:
                 })
 
             if entry.ai_text:
-                last_ai_text = entry.ai_text
+                last_ai_text = interned.setdefault(entry.ai_text, entry.ai_text)
                 last_ai_meta = {
                     "timestamp": entry.timestamp,
                     "step_id": entry.step_id,
@@ -200,71 +236,96 @@ class DialogueLogParser:
 class DialogueMatcher:
     """对话匹配器"""
 
-    def __init__(self, similarity_threshold: float = 0.7):
+    # rapidfuzz 打分函数；ratio 与 difflib 口径一致，wratio / token_set_ratio 对语序、
+    # 局部重合更宽容，需配合更高的阈值使用
+    SCORERS = ("ratio", "wratio", "token_set_ratio")
+
+    def __init__(self, similarity_threshold: float = 0.7, scorer: Optional[str] = None):
         """
         初始化匹配器
 
         Args:
             similarity_threshold: 相似度阈值，默认0.7
+            scorer: 批量打分函数名（ratio / wratio / token_set_ratio），
+                默认读取环境变量 REPLAY_SCORER，未设置时为 ratio；仅在安装 rapidfuzz 时生效
         """
         self.threshold = similarity_threshold
+        self.scorer_name = (scorer or os.getenv("REPLAY_SCORER") or "ratio").lower()
+        if self.scorer_name not in self.SCORERS:
+            print(f"⚠️  未知的 REPLAY_SCORER: {self.scorer_name}，使用 ratio")
+            self.scorer_name = "ratio"
+        self._scorer = None
+        if fuzz is not None:
+            self._scorer = {
+                "ratio": fuzz.ratio,
+                "wratio": fuzz.WRatio,
+                "token_set_ratio": fuzz.token_set_ratio,
+            }[self.scorer_name]
+
+    def report_match(self, best_pair: Optional[Dict], best_similarity: float):
+        """打印匹配结果"""
+        if best_pair and best_pair.get("user"):
+            print(f"✅ 找到匹配回答，相似度: {best_similarity:.2f}")
+            print(f"   原始AI提问: {best_pair.get('ai', '')[:50]}...")
+            print(f"   时间: {best_pair.get('timestamp')}, 步骤: {best_pair.get('step_id')}")
+        else:
+            print(f"❌ 未找到匹配回答 (所有候选均低于阈值: {self.threshold})")
 
-    def find_best_match(
+    def best_candidate(
         self,
         ai_question: str,
-        dialogue_pairs: List[Dict],
-        step_id: Optional[str] = None,
-    ) -> Optional[str]:
+        candidates: List[Dict],
+        floor: float = 0.0,
+    ) -> Tuple[Optional[Dict], float]:
         """
-        查找最佳匹配的用户回答
+        返回相似度最高的对话对
+
+        候选应按时间倒序排列：相似度相同时取最近的一条。安装 rapidfuzz 时用
+        process.cdist 一次性批量打分；否则逐条扫描。两种方式都取真正的最高分。
 
         Args:
             ai_question: 当前AI提问
-            dialogue_pairs: 历史对话对列表
+            candidates: 候选对话对列表
+            floor: 最低相似度，低于该值的候选不会被选中
 
         Returns:
-            匹配的用户回答，或None表示未找到
+            (最佳对话对或None, 相似度)
         """
-        if not dialogue_pairs:
-            return None
+        if not ai_question or not candidates:
+            return None, 0.0
+        q_norm = self._normalize(ai_question)
+        if not q_norm:
+            return None, 0.0
+
+        if process is not None:
+            scores = process.cdist(
+                [q_norm],
+                [self._pair_ai_norm(pair) for pair in candidates],
+                scorer=self._scorer,
+                processor=None,
+                score_cutoff=floor * 100,
+            )[0]
+            best = int(np.argmax(scores))  # 并列时取第一个，即最近的一条
+            if scores[best] <= 0 or scores[best] < floor * 100:
+                return None, 0.0
+            return candidates[best], float(scores[best]) / 100.0
 
-        candidates = dialogue_pairs
-        if step_id:
-            step_candidates = [p for p in dialogue_pairs if p.get("step_id") == step_id]
-            if step_candidates:
-                candidates = step_candidates
-
-        best_match = None
+        best_pair = None
         best_similarity = 0.0
-        best_pair_info = None
-
         for pair in candidates:
-            historical_ai = pair.get("ai", "")
-            if not historical_ai:
+            if not pair.get("ai"):
                 continue
 
-            similarity = self.calculate_similarity(ai_question, historical_ai)
-
-            if similarity > best_similarity and similarity >= self.threshold:
+            similarity = self._score(
+                q_norm,
+                self._pair_ai_norm(pair),
+                score_cutoff=max(best_similarity, floor),
+            )
+            if similarity > best_similarity and similarity >= floor:
                 best_similarity = similarity
-                best_match = pair.get("user")
-                best_pair_info = {
-                    "similarity": similarity,
-                    "historical_ai": historical_ai,
-                    "timestamp": pair.get("timestamp"),
-                    "step_id": pair.get("step_id"),
-                    "round_num": pair.get("round_num")
-                }
-
-        if best_match:
-            print(f"✅ 找到匹配回答，相似度: {best_similarity:.2f}")
-            if best_pair_info:
-                print(f"   原始AI提问: {best_pair_info['historical_ai'][:50]}...")
-                print(f"   时间: {best_pair_info.get('timestamp')}, 步骤: {best_pair_info.get('step_id')}")
-        else:
-            print(f"❌ 未找到匹配回答 (最高相似度: {best_similarity:.2f}, 阈值: {self.threshold})")
+                best_pair = pair
 
-        return best_match
+        return best_pair, best_similarity
 
     @staticmethod
     def calculate_similarity(text1: str, text2: str) -> float:
@@ -281,12 +342,40 @@ class DialogueMatcher:
         if not text1 or not text2:
             return 0.0
 
-        # 预处理：去除多余空格和换行符
-        text1_clean = ' '.join(text1.split())
-        text2_clean = ' '.join(text2.split())
+        return DialogueMatcher._score(
+            DialogueMatcher._normalize(text1),
+            DialogueMatcher._normalize(text2),
+        )
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _normalize(text: str) -> str:
+        """预处理：去除多余空格和换行符（相同文本只计算一次）"""
+        return ' '.join(text.split())
+
+    @staticmethod
+    def _pair_ai_norm(pair: Dict) -> str:
+        """返回对话对中 AI 提问的预处理文本，首次计算后缓存在 pair["_ai_norm"]"""
+        ai_norm = pair.get("_ai_norm")
+        if ai_norm is None:
+            ai_norm = DialogueMatcher._normalize(pair.get("ai") or "")
+            pair["_ai_norm"] = ai_norm
+        return ai_norm
 
-        # 使用difflib计算相似度
-        return difflib.SequenceMatcher(None, text1_clean, text2_clean).ratio()
+    @staticmethod
+    def _score(text1_clean: str, text2_clean: str, score_cutoff: float = 0.0) -> float:
+        """对已预处理的两个文本打分 (0.0-1.0)；低于 score_cutoff 时返回 0"""
+        if fuzz is not None:
+            return fuzz.ratio(text1_clean, text2_clean, score_cutoff=score_cutoff * 100) / 100.0
+
+        # 使用difflib计算相似度；先用 O(1) 的长度上界和 O(n) 的字符计数上界剪枝，
+        # 只有可能超过 score_cutoff 的候选才计算 O(n·m) 的 ratio()
+        matcher = difflib.SequenceMatcher(None, text1_clean, text2_clean)
+        if score_cutoff > 0 and (
+            matcher.real_quick_ratio() < score_cutoff or matcher.quick_ratio() < score_cutoff
+        ):
+            return 0.0
+        return matcher.ratio()
 
 
 class DialogueReplayEngine:
@@ -305,13 +394,25 @@ class DialogueReplayEngine:
         self.parser = DialogueLogParser()
         self.matcher = DialogueMatcher(similarity_threshold)
         self.dialogue_pairs = None
+        self._recent_pairs: List[Dict] = []
+        self._by_step: Dict[str, List[Dict]] = {}
         self.loaded = False
+        # 回放中同一 AI 提问常重复出现，缓存 (ai_question, step_id) -> 匹配结果，
+        # get_answer 与 get_match_info 共用一次打分
+        self._match_cache = functools.lru_cache(maxsize=512)(self._score_once)
 
     def load_log(self) -> bool:
         """加载和解析日志文件"""
         try:
             entries = self.parser.parse_log_file(self.log_path)
             self.dialogue_pairs = self.parser.extract_dialogue_pairs(entries)
+            # 日志按时间顺序追加，倒序即为最近优先，便于匹配时提前结束扫描
+            self._recent_pairs = self.dialogue_pairs[::-1]
+            by_step: Dict[str, List[Dict]] = defaultdict(list)
+            for pair in self._recent_pairs:
+                by_step[pair.get("step_id")].append(pair)
+            self._by_step = by_step
+            self._match_cache.cache_clear()
             self.loaded = True
             return True
         except Exception as e:
@@ -333,7 +434,33 @@ class DialogueReplayEngine:
             print("⚠️  日志未加载或为空")
             return None
 
-        return self.matcher.find_best_match(ai_question, self.dialogue_pairs, step_id=step_id)
+        info = self._match_cache(ai_question, step_id)
+        best_pair = info["pair"] if info["matched"] else None
+        self.matcher.report_match(best_pair, info["similarity"])
+        return best_pair.get("user") if best_pair else None
+
+    def _score_once(self, ai_question: str, step_id: Optional[str]) -> Dict:
+        """对候选打分一次，返回匹配信息（含最佳对话对 pair）"""
+        candidates = self._candidates(step_id)
+        best_pair, best_similarity = self.matcher.best_candidate(ai_question, candidates)
+        return {
+            "matched": best_pair is not None and best_similarity >= self.threshold,
+            "similarity": best_similarity,
+            "answer": best_pair.get("user") if best_pair else None,
+            "threshold": self.threshold,
+            "historical_ai": best_pair.get("ai") if best_pair else None,
+            "timestamp": best_pair.get("timestamp") if best_pair else None,
+            "step_id": best_pair.get("step_id") if best_pair else None,
+            "round_num": best_pair.get("round_num") if best_pair else None,
+            "total_pairs": len(candidates),
+            "pair": best_pair,
+        }
+
+    def _candidates(self, step_id: Optional[str]) -> List[Dict]:
+        """优先返回当前步骤的对话对，没有时回退到全部对话对（均为最近优先）"""
+        if step_id:
+            return self._by_step.get(step_id) or self._recent_pairs
+        return self._recent_pairs
 
     def get_match_info(self, ai_question: str, step_id: Optional[str] = None) -> Dict:
         """
@@ -349,39 +476,9 @@ class DialogueReplayEngine:
         if not self.loaded or not self.dialogue_pairs:
             return {"error": "日志未加载或为空"}
 
-        best_match = None
-        best_similarity = 0.0
-        best_pair = None
-
-        candidates = self.dialogue_pairs
-        if step_id:
-            step_candidates = [p for p in self.dialogue_pairs if p.get("step_id") == step_id]
-            if step_candidates:
-                candidates = step_candidates
-
-        for pair in candidates:
-            historical_ai = pair.get("ai", "")
-            if not historical_ai:
-                continue
-
-            similarity = self.matcher.calculate_similarity(ai_question, historical_ai)
-
-            if similarity > best_similarity:
-                best_similarity = similarity
-                best_match = pair.get("user")
-                best_pair = pair
-
-        return {
-            "matched": best_similarity >= self.threshold,
-            "similarity": best_similarity,
-            "answer": best_match,
-            "threshold": self.threshold,
-            "historical_ai": best_pair.get("ai") if best_pair else None,
-            "timestamp": best_pair.get("timestamp") if best_pair else None,
-            "step_id": best_pair.get("step_id") if best_pair else None,
-            "round_num": best_pair.get("round_num") if best_pair else None,
-            "total_pairs": len(candidates)
-        }
+        info = dict(self._match_cache(ai_question, step_id))
+        info.pop("pair", None)
+        return info
 
 
 class EmbeddingClient:
@@ -394,6 +491,7 @@ class EmbeddingClient:
         model: str = "text-embedding-3-small",
         max_batch_size: int = 25,
         timeout: int = 60,
+        max_workers: int = 4,
     ):
         self.api_key = api_key
         base_url = base_url.rstrip("/")
@@ -401,35 +499,90 @@ class EmbeddingClient:
         self.model = model
         self.max_batch_size = max_batch_size
         self.timeout = timeout
-        self.session = requests.Session()
+        # 并发请求的批次数，受服务端限流约束时可调小（1 即串行）
+        self.max_workers = max(1, max_workers)
+        # Keep-alive pool + retries on transient errors (embedding POSTs are idempotent).
+        self.session = mount_http_adapter(
+            requests.Session(),
+            pool_connections=4,
+            pool_maxsize=max(8, self.max_workers),
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset({"POST"}),
+                raise_on_status=False,
+            ),
+        )
+        self._emb_cache: Dict[str, List[float]] = {}
+
+    def embed_one(self, text: str) -> List[float]:
+        """Embed a single text, reusing the result for repeated inputs."""
+        emb = self._emb_cache.get(text)
+        if emb is None:
+            emb = self.embed_texts([text])[0]
+            if emb is None:
+                raise ValueError("embedding response is missing the requested item")
+            self._emb_cache[text] = emb
+        return emb
 
     def embed_texts(self, texts: List[str]) -> List[List[float]]:
         if not texts:
             return []
 
-        embeddings: List[List[float]] = []
+        # 按绝对位置写入；接口漏返回的条目保持为 None，由调用方校验
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        starts = range(0, len(texts), self.max_batch_size)
+
+        def _fill(start: int, items: List[Dict]):
+            size = min(self.max_batch_size, len(texts) - start)
+            for j, it in enumerate(items):
+                # The API returns items in input order; "index" is only trusted when present.
+                k = it.get("index", j)
+                if 0 <= k < size:
+                    embeddings[start + k] = it.get("embedding")
+
+        if self.max_workers == 1 or len(starts) == 1:
+            for start in starts:
+                _fill(start, self._embed_one_batch(texts[start : start + self.max_batch_size]))
+            return embeddings
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(starts))) as ex:
+            futures = {
+                ex.submit(self._embed_one_batch, texts[start : start + self.max_batch_size]): start
+                for start in starts
+            }
+            for fut in as_completed(futures):
+                _fill(futures[fut], fut.result())
+
+        return embeddings
+
+    def _embed_one_batch(self, batch: List[str]) -> List[Dict]:
+        """POST one batch and return the raw response items."""
         headers = {
             "Content-Type": "application/json",
             "api-key": self.api_key,
         }
-
-        for i in range(0, len(texts), self.max_batch_size):
-            batch = texts[i : i + self.max_batch_size]
-            payload = {"input": batch, "model": self.model}
-            resp = self.session.post(self.embed_url, json=payload, headers=headers, timeout=self.timeout)
-            resp.raise_for_status()
-            data = resp.json() or {}
-            items = data.get("data") or []
-            # Ensure original ordering by index if provided.
-            items = sorted(items, key=lambda x: x.get("index", 0))
-            embeddings.extend([it.get("embedding") for it in items])
-
-        return embeddings
+        payload = {"input": batch, "model": self.model}
+        resp = self.session.post(self.embed_url, json=payload, headers=headers, timeout=self.timeout)
+        resp.raise_for_status()
+        data = resp.json() or {}
+        return data.get("data") or []
 
 
 class JsonDialogueReplayEngine:
     """Replay engine based on exported dialogue JSON + embeddings."""
 
+    # 超过该对话对数量时使用 HNSW 近似索引，否则使用精确的 FlatIP
+    HNSW_MIN_PAIRS = 1000
+    HNSW_M = 32
+    # HNSW 索引使用 8bit 标量量化存储向量，取 top-k 后用 float32 精确重排
+    RERANK_K = 5
+    HNSW_EF_SEARCH = 64
+    # 无 faiss 时，超过该对话对数量则对矩阵做 k-means 分簇，按簇上界剪枝
+    CLUSTER_MIN_PAIRS = 2000
+    CLUSTER_ITERS = 5
+
     def __init__(
         self,
         json_path: str,
@@ -444,18 +597,35 @@ class JsonDialogueReplayEngine:
         self.dialogue_pairs: List[Dict] = []
         self.loaded = False
         self.embed_client: Optional[EmbeddingClient] = None
-        self._last_query_key = None
-        self._last_match_info: Optional[Dict] = None
+        # (N, D) float32，行已做 L2 归一化，点积即余弦相似度
+        self._emb_matrix: Optional[np.ndarray] = None
+        # step_id -> 该步骤对话对在 _emb_matrix 中的行号
+        self._step_index: Dict[str, np.ndarray] = {}
+        self._exact_rows: Dict[str, List[int]] = {}
+        # faiss 可用时的全量索引及按步骤懒加载的子索引
+        self._index = None
+        self._step_indexes: Dict[str, object] = {}
+        # 无 faiss 时的簇中心 (K, D)、簇半径 (K,) 与各簇成员行号
+        self._centroids: Optional[np.ndarray] = None
+        self._cluster_radius: Optional[np.ndarray] = None
+        self._cluster_members: List[np.ndarray] = []
+        # 按簇重排后的矩阵，使每个簇在内存中连续，扫描时无需 fancy-index 拷贝
+        self._cluster_matrix: Optional[np.ndarray] = None
+        self._cluster_bounds: Optional[np.ndarray] = None
+        # 归一化提问 -> 归一化 query 向量，避免重复提问再次请求 embedding 接口
+        self._query_vec_cache = functools.lru_cache(maxsize=512)(self._embed_query)
+        # (原始提问, step_id) -> 匹配结果，get_answer 与 get_match_info 共用一次打分
+        self._match_cache = functools.lru_cache(maxsize=256)(self._score_once)
 
     @staticmethod
     def _normalize_question(text: str) -> str:
         # Strip think tags / artifacts.
-        text = re.sub(r"</?think[^>]*>", "", text or "")
+        text = _THINK_RE.sub("", text or "")
         text = text.strip()
         if not text:
             return text
         # Take the last sentence ending with '?' or '？' to reduce noise.
-        matches = re.findall(r"[^。！？\n\r]*[？\?]", text)
+        matches = _Q_RE.findall(text)
         if matches:
             return matches[-1].strip()
         return text
@@ -466,6 +636,8 @@ class JsonDialogueReplayEngine:
         last_ai_norm: Optional[str] = None
         last_step_id: Optional[str] = None
         last_stage_index: Optional[int] = None
+        # Repeated assistant messages share one raw/normalized string pair.
+        interned: Dict[str, Tuple[str, str]] = {}
 
         for stage in data.get("stages", []) or []:
             step_id = stage.get("step_id") or stage.get("stepId")
@@ -476,8 +648,10 @@ class JsonDialogueReplayEngine:
                 if not content:
                     continue
                 if role == "assistant":
-                    last_ai_raw = content
-                    last_ai_norm = self._normalize_question(content)
+                    cached = interned.get(content)
+                    if cached is None:
+                        cached = interned[content] = (content, self._normalize_question(content))
+                    last_ai_raw, last_ai_norm = cached
                     last_step_id = step_id
                     last_stage_index = stage_index
                 elif role == "user" and last_ai_norm:
@@ -493,31 +667,19 @@ class JsonDialogueReplayEngine:
 
     def load_log(self) -> bool:
         try:
-            with open(self.json_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(self.json_path, "rb") as f:
+                data = _loads(f.read())
         except Exception as e:
             print(f"❌ 读取 JSON 回放文件失败: {str(e)}")
             return False
 
         self.dialogue_pairs = self._parse_json_pairs(data)
+        self._query_vec_cache.cache_clear()
+        self._match_cache.cache_clear()
         if not self.dialogue_pairs:
             print("⚠️  JSON 中未提取到可用对话对")
             return False
 
-        # Try load cached embeddings to avoid recomputation.
-        cache_path = Path(self.json_path).with_name(Path(self.json_path).stem + "_replay_index.json")
-        if cache_path.exists():
-            try:
-                with open(cache_path, "r", encoding="utf-8") as f:
-                    cached = json.load(f)
-                if isinstance(cached, list) and all("emb" in p for p in cached):
-                    self.dialogue_pairs = cached
-                    self.loaded = True
-                    print(f"✅ 已加载 embedding 索引缓存: {str(cache_path)}")
-                    return True
-            except Exception:
-                pass
-
         api_key = os.getenv("EMBEDDING_API_KEY") or os.getenv("ARK_API_KEY")
         if not api_key:
             print("❌ 未设置 EMBEDDING_API_KEY，无法生成 embedding")
@@ -530,19 +692,51 @@ class JsonDialogueReplayEngine:
             max_batch_size=6 if "embedding-v3" in self.embedding_model or self.embedding_model.endswith("v3") else 25,
         )
 
+        # Embedding cache: pair metadata as JSON sidecar + normalized (N, D) matrix as .npy.
+        # 磁盘上以 float16 存储（体积减半），加载时一次性转回 float32 供检索使用
+        json_path = Path(self.json_path)
+        meta_path = json_path.with_name(json_path.stem + "_replay_meta.json")
+        emb_path = json_path.with_name(json_path.stem + "_replay_emb.npy")
+        if meta_path.exists() and emb_path.exists():
+            try:
+                with open(meta_path, "rb") as f:
+                    cached = _loads(f.read())
+                matrix = np.load(emb_path, mmap_mode="r")
+                # 仅当提问文本一致时复用矩阵；回答取自最新解析结果，便于手动修改后回放
+                if (
+                    isinstance(cached, list)
+                    and matrix.ndim == 2
+                    and matrix.shape[0] == len(self.dialogue_pairs)
+                    and [p.get("ai") for p in cached] == [p["ai"] for p in self.dialogue_pairs]
+                ):
+                    if matrix.dtype != np.float32:
+                        matrix = matrix.astype(np.float32)
+                        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-9
+                    self._set_emb_matrix(matrix)
+                    self.loaded = True
+                    print(f"✅ 已加载 embedding 索引缓存: {str(emb_path)}")
+                    return True
+            except Exception:
+                pass
+
         try:
-            texts = [p["ai"] for p in self.dialogue_pairs]
-            embs = self.embed_client.embed_texts(texts)
-            if len(embs) != len(self.dialogue_pairs):
+            # 重复出现的提问只请求一次 embedding，再按行号展开回每个对话对
+            row_of: Dict[str, int] = {}
+            rows = [row_of.setdefault(p["ai"], len(row_of)) for p in self.dialogue_pairs]
+            embs = self.embed_client.embed_texts(list(row_of))
+            if len(embs) != len(row_of) or any(e is None for e in embs):
                 print("⚠️  embedding 数量与对话对数量不一致，将回退到普通模式")
                 return False
-            for p, e in zip(self.dialogue_pairs, embs):
-                p["emb"] = e
+            unique = np.asarray(embs, dtype=np.float32)
+            unique /= np.linalg.norm(unique, axis=1, keepdims=True) + 1e-9
+            matrix = unique[rows]
+            self._set_emb_matrix(matrix)
             # Write cache.
             try:
-                with open(cache_path, "w", encoding="utf-8") as f:
-                    json.dump(self.dialogue_pairs, f, ensure_ascii=False)
-                print(f"✅ 已写入 embedding 索引缓存: {str(cache_path)}")
+                np.save(emb_path, matrix.astype(np.float16))
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    f.write(_dumps(self.dialogue_pairs))
+                print(f"✅ 已写入 embedding 索引缓存: {str(emb_path)}")
             except Exception:
                 pass
             self.loaded = True
@@ -551,40 +745,174 @@ class JsonDialogueReplayEngine:
             print(f"❌ 生成 embedding 失败: {str(e)}")
             return False
 
-    @staticmethod
-    def _cosine(a: List[float], b: List[float]) -> float:
-        dot = sum(x * y for x, y in zip(a, b))
-        na = math.sqrt(sum(x * x for x in a))
-        nb = math.sqrt(sum(y * y for y in b))
-        return dot / (na * nb + 1e-9)
+    def _set_emb_matrix(self, matrix: np.ndarray):
+        """Use a normalized embedding matrix and index its rows by step_id."""
+        self._emb_matrix = matrix
+
+        rows_by_step: Dict[str, List[int]] = {}
+        for i, p in enumerate(self.dialogue_pairs):
+            sid = p.get("step_id")
+            if sid:
+                rows_by_step.setdefault(sid, []).append(i)
+        self._step_index = {sid: np.asarray(rows, dtype=np.intp) for sid, rows in rows_by_step.items()}
+
+        # 归一化提问 -> 行号（按出现顺序），完全相同的提问无需请求 embedding
+        exact_rows: Dict[str, List[int]] = defaultdict(list)
+        for i, p in enumerate(self.dialogue_pairs):
+            exact_rows[p["ai"]].append(i)
+        self._exact_rows = dict(exact_rows)
+
+        self._step_indexes = {}
+        self._index = self._build_index(matrix) if _optional_faiss() is not None else None
+        self._centroids = None
+        self._cluster_radius = None
+        self._cluster_members = []
+        self._cluster_matrix = None
+        self._cluster_bounds = None
+        if self._index is None and matrix.shape[0] >= self.CLUSTER_MIN_PAIRS:
+            self._build_clusters(matrix)
+
+    def _build_clusters(self, matrix: np.ndarray):
+        """Partition rows with a few k-means rounds (K ~ sqrt(N)) for bounded search."""
+        n = matrix.shape[0]
+        k = max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(0)
+        centroids = np.array(matrix[rng.choice(n, k, replace=False)], dtype=np.float32)
+
+        for _ in range(self.CLUSTER_ITERS):
+            # argmin ||v - c||^2 == argmax (v·c - ||c||^2 / 2)
+            labels = np.argmax(matrix @ centroids.T - 0.5 * np.einsum("ij,ij->i", centroids, centroids), axis=1)
+            for c in range(k):
+                members = matrix[labels == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+
+        labels = np.argmax(matrix @ centroids.T - 0.5 * np.einsum("ij,ij->i", centroids, centroids), axis=1)
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(k + 1))
+        clustered = np.ascontiguousarray(matrix[order], dtype=np.float32)
+        radius = np.zeros(k, dtype=np.float32)
+        for c in range(k):
+            block = clustered[bounds[c]:bounds[c + 1]]
+            if len(block):
+                radius[c] = float(np.linalg.norm(block - centroids[c], axis=1).max())
+
+        self._centroids = centroids
+        self._cluster_radius = radius
+        self._cluster_members = [order[bounds[c]:bounds[c + 1]] for c in range(k)]
+        self._cluster_matrix = clustered
+        self._cluster_bounds = bounds
+
+    def _nearest_clustered(self, q_vec: np.ndarray) -> Tuple[Optional[int], float]:
+        """
+        Exact nearest neighbour over all rows using cluster pruning.
 
-    def get_answer(self, ai_question: str, step_id: Optional[str] = None) -> Optional[str]:
-        if not self.loaded or not self.dialogue_pairs or not self.embed_client:
-            print("⚠️  JSON 回放引擎未加载")
+        For a member v of cluster c, q·v <= q·c + ||v - c|| <= q·c + radius_c, so clusters
+        are visited by that upper bound and the scan stops once it cannot beat the best hit.
+        """
+        bounds = self._centroids @ q_vec + self._cluster_radius
+        best_row: Optional[int] = None
+        best_sim = 0.0
+        for c in np.argsort(-bounds):
+            if bounds[c] <= best_sim:
+                break
+            start, end = self._cluster_bounds[c], self._cluster_bounds[c + 1]
+            if start == end:
+                continue
+            sims = self._cluster_matrix[start:end] @ q_vec
+            j = int(np.argmax(sims))
+            if sims[j] > best_sim:
+                best_sim = float(sims[j])
+                best_row = int(self._cluster_members[c][j])
+        return best_row, best_sim
+
+    @classmethod
+    def _build_index(cls, matrix: np.ndarray):
+        """Build an inner-product faiss index over normalized rows."""
+        faiss = _optional_faiss()
+        n, d = matrix.shape
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        if n > cls.HNSW_MIN_PAIRS:
+            index = faiss.IndexHNSWSQ(d, faiss.ScalarQuantizer.QT_8bit, cls.HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.train(matrix)
+            index.hnsw.efSearch = cls.HNSW_EF_SEARCH
+        else:
+            index = faiss.IndexFlatIP(d)
+        index.add(matrix)
+        return index
+
+    def _exact_match(self, q_norm: str, step_id: Optional[str]) -> Optional[Tuple[int, float, int]]:
+        """Return (row, 1.0, candidate count) if the normalized question was seen verbatim."""
+        rows = self._exact_rows.get(q_norm)
+        if not rows:
             return None
+        step_rows = self._step_index.get(step_id) if step_id else None
+        if step_rows is None:
+            return rows[0], 1.0, len(self.dialogue_pairs)
+        for row in rows:
+            if self.dialogue_pairs[row].get("step_id") == step_id:
+                return row, 1.0, int(step_rows.size)
+        return None
 
+    def _nearest(self, q_vec: np.ndarray, step_id: Optional[str]) -> Tuple[Optional[int], float, int]:
+        """Return (pair row, cosine similarity, candidate count) of the closest pair."""
+        rows = self._step_index.get(step_id) if step_id else None
+
+        if self._index is not None:
+            index = self._index
+            if rows is not None:
+                index = self._step_indexes.get(step_id)
+                if index is None:
+                    index = self._build_index(self._emb_matrix[rows])
+                    self._step_indexes[step_id] = index
+            count = int(index.ntotal)
+            if not count:
+                return None, 0.0, 0
+            _, I = index.search(q_vec.reshape(1, -1), min(self.RERANK_K, count))
+            hits = I[0][I[0] >= 0]
+            if not hits.size:
+                return None, 0.0, count
+            # 量化得分只用于召回，最终相似度以 float32 向量重新计算
+            if rows is not None:
+                hits = rows[hits]
+            sims = self._emb_matrix[hits] @ q_vec
+            best = int(np.argmax(sims))
+            best_sim = float(sims[best])
+            if best_sim <= 0.0:
+                return None, 0.0, count
+            return int(hits[best]), best_sim, count
+        elif rows is None and self._centroids is not None:
+            best_row, best_sim = self._nearest_clustered(q_vec)
+            return best_row, best_sim, int(self._emb_matrix.shape[0])
+        else:
+            sims = self._emb_matrix[rows] @ q_vec if rows is not None else self._emb_matrix @ q_vec
+            count = int(sims.size)
+            if not count:
+                return None, 0.0, 0
+            best_row = int(np.argmax(sims))
+            best_sim = float(sims[best_row])
+
+        if best_sim <= 0.0:
+            return None, 0.0, count
+        return (int(rows[best_row]) if rows is not None else best_row), best_sim, count
+
+    def _embed_query(self, q_norm: str) -> np.ndarray:
+        q_vec = np.asarray(self.embed_client.embed_one(q_norm), dtype=np.float32)
+        q_vec /= np.linalg.norm(q_vec) + 1e-9
+        q_vec.setflags(write=False)  # shared by cache hits
+        return q_vec
+
+    def _score_once(self, ai_question: str, step_id: Optional[str] = None) -> Dict:
+        """Score the question against all candidates once and return the full match info."""
         q_norm = self._normalize_question(ai_question)
-        q_emb = self.embed_client.embed_texts([q_norm])[0]
-
-        candidates = self.dialogue_pairs
-        if step_id:
-            step_candidates = [p for p in self.dialogue_pairs if p.get("step_id") == step_id]
-            if step_candidates:
-                candidates = step_candidates
-
-        best_pair = None
-        best_sim = 0.0
-        for p in candidates:
-            emb = p.get("emb")
-            if not emb:
-                continue
-            sim = self._cosine(q_emb, emb)
-            if sim > best_sim:
-                best_sim = sim
-                best_pair = p
+        exact = self._exact_match(q_norm, step_id)
+        if exact is not None:
+            best_row, best_sim, candidates_count = exact
+        else:
+            best_row, best_sim, candidates_count = self._nearest(self._query_vec_cache(q_norm), step_id)
+        best_pair = self.dialogue_pairs[best_row] if best_row is not None else None
 
-        self._last_query_key = (ai_question, step_id)
-        self._last_match_info = {
+        return {
             "matched": bool(best_pair and best_sim >= self.threshold),
             "similarity": best_sim,
             "answer": best_pair.get("user") if best_pair else None,
@@ -592,23 +920,132 @@ class JsonDialogueReplayEngine:
             "historical_ai": (best_pair.get("ai_raw") or best_pair.get("ai")) if best_pair else None,
             "step_id": best_pair.get("step_id") if best_pair else None,
             "round_num": best_pair.get("round_num") if best_pair else None,
-            "total_pairs": len(candidates),
+            "total_pairs": candidates_count,
         }
 
-        if best_pair and best_sim >= self.threshold:
-            print(f"✅ JSON 回放命中，相似度: {best_sim:.3f}")
-            return best_pair.get("user")
+    def get_answer(self, ai_question: str, step_id: Optional[str] = None) -> Optional[str]:
+        if not self.loaded or not self.dialogue_pairs or not self.embed_client:
+            print("⚠️  JSON 回放引擎未加载")
+            return None
+
+        info = self._match_cache(ai_question, step_id)
+        if info["matched"]:
+            print(f"✅ JSON 回放命中，相似度: {info['similarity']:.3f}")
+            return info["answer"]
 
-        print(f"❌ JSON 回放未命中 (最高相似度: {best_sim:.3f}, 阈值: {self.threshold})")
+        print(f"❌ JSON 回放未命中 (最高相似度: {info['similarity']:.3f}, 阈值: {self.threshold})")
         return None
 
     def get_match_info(self, ai_question: str, step_id: Optional[str] = None) -> Dict:
-        key = (ai_question, step_id)
-        if self._last_query_key == key and self._last_match_info:
-            return self._last_match_info
-        # Fallback: run a match to populate info.
-        _ = self.get_answer(ai_question, step_id=step_id)
-        return self._last_match_info or {"matched": False, "similarity": 0.0}
+        if not self.loaded or not self.dialogue_pairs or not self.embed_client:
+            return {"matched": False, "similarity": 0.0}
+        # 返回副本，避免调用方修改缓存中的结果
+        return dict(self._match_cache(ai_question, step_id))
+
+
+class SemanticAnswerCache:
+    """Two-layer cache of generated answers: exact question hash first, then embedding cosine lookup.
+
+    Entries are partitioned by scope: the student profile plus a digest of the task and
+    the prompt context (knowledge base, dialogue samples). A cached answer is only reused
+    for the same profile in the same course. Persisted as a JSON sidecar + (N, D) .npy matrix.
+    """
+
+    def __init__(self, cache_dir: Path, embed_client: EmbeddingClient, threshold: float = 0.9):
+        self.meta_path = Path(cache_dir) / "semantic_cache_meta.json"
+        self.emb_path = Path(cache_dir) / "semantic_cache_emb.npy"
+        self.embed_client = embed_client
+        self.threshold = threshold
+        self._entries: List[Dict] = []
+        self._exact: Dict[Tuple[str, str], str] = {}
+        self._rows_by_scope: Dict[str, List[int]] = defaultdict(list)
+        self._vectors: List[np.ndarray] = []
+        # scope -> (rows, matrix)，新增条目后重建
+        self._scope_matrix: Dict[str, Tuple[List[int], np.ndarray]] = {}
+        self._dirty = False
+
+    @staticmethod
+    def make_scope(profile: str, *context: Optional[str]) -> str:
+        """Build a scope key from the profile and the texts a cached answer depends on."""
+        digest = hashlib.md5()
+        for part in context:
+            digest.update((part or "").encode("utf-8"))
+            digest.update(b"\0")
+        return f"{profile}:{digest.hexdigest()}"
+
+    @staticmethod
+    def _key(question: str) -> str:
+        return hashlib.md5(" ".join(question.split()).encode("utf-8")).hexdigest()
+
+    def _embed(self, question: str) -> np.ndarray:
+        vec = np.asarray(self.embed_client.embed_one(" ".join(question.split())), dtype=np.float32)
+        return vec / (np.linalg.norm(vec) + 1e-9)
+
+    def load(self) -> int:
+        """Load persisted entries; returns the number of entries loaded."""
+        if not (self.meta_path.exists() and self.emb_path.exists()):
+            return 0
+        try:
+            with open(self.meta_path, "rb") as f:
+                entries = _loads(f.read())
+            matrix = np.load(self.emb_path).astype(np.float32)
+        except Exception as e:
+            print(f"⚠️  语义缓存读取失败，将重新建立: {str(e)}")
+            return 0
+        if not isinstance(entries, list) or matrix.ndim != 2 or matrix.shape[0] != len(entries):
+            return 0
+        loaded = 0
+        for entry, vec in zip(entries, matrix):
+            # 早期条目没有 scope（未区分课程上下文），不再复用
+            if entry.get("scope"):
+                self._insert(entry["scope"], entry["question"], entry["answer"], vec)
+                loaded += 1
+        self._dirty = loaded != len(entries)
+        return loaded
+
+    def _insert(self, scope: str, question: str, answer: str, vec: np.ndarray):
+        row = len(self._entries)
+        self._entries.append({"scope": scope, "question": question, "answer": answer})
+        self._exact[(scope, self._key(question))] = answer
+        self._rows_by_scope[scope].append(row)
+        self._vectors.append(vec)
+        self._scope_matrix.pop(scope, None)
+        self._dirty = True
+
+    def lookup(self, scope: str, question: str) -> Optional[str]:
+        """Return a cached answer for a (near-)duplicate question, or None."""
+        answer = self._exact.get((scope, self._key(question)))
+        if answer is not None:
+            return answer
+
+        rows = self._rows_by_scope.get(scope)
+        if not rows:
+            return None
+        cached = self._scope_matrix.get(scope)
+        if cached is None:
+            cached = (list(rows), np.vstack([self._vectors[r] for r in rows]))
+            self._scope_matrix[scope] = cached
+        cached_rows, matrix = cached
+
+        sims = matrix @ self._embed(question)
+        best = int(np.argmax(sims))
+        if float(sims[best]) >= self.threshold:
+            return self._entries[cached_rows[best]]["answer"]
+        return None
+
+    def add(self, scope: str, question: str, answer: str):
+        if not question or not answer or (scope, self._key(question)) in self._exact:
+            return
+        self._insert(scope, question, answer, self._embed(question))
+
+    def save(self):
+        if not self._dirty or not self._entries:
+            return
+        self.meta_path.parent.mkdir(parents=True, exist_ok=True)
+        np.save(self.emb_path, np.vstack(self._vectors).astype(np.float16))
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            f.write(_dumps(self._entries))
+        self._dirty = False
 
 
 class WorkflowTester(WorkflowTesterBase):
@@ -637,8 +1074,46 @@ class WorkflowTester(WorkflowTesterBase):
         }
     }
 
+    SYSTEM_PROMPT = "你是一名能力训练助手，需要严格按照给定的学生档位扮演角色。"
+
+    # 问题类型识别（优先级最高），与档位无关
+    PROMPT_QUESTION_TYPES = "\n".join([
+        "## 问题类型识别（优先级最高）",
+        "如果当前问题属于以下类型，请优先直接回答，不需要强制体现性格特点：",
+        "1. **确认式问题**: 如'你准备好了吗？请回复是或否'、'确认的话请回复是'",
+        "   → 直接回答'是'、'好的'、'确认'等",
+        "2. **选择式问题**: 如'你选择A还是B？'、'请选择1/2/3'",
+        "   → 直接说出选项，如'我选择A'、'选1'",
+        "3. **角色确认问题**: 如'你是学生还是老师？'",
+        "   → 直接回答角色，如'学生'",
+        "",
+        "**判断标准**: 如果问题中包含'请回复'、'请选择'、'是或否'、'A/B/C'等明确指示，则为封闭式问题。",
+        "",
+    ])
+
+    # 当前问题之后的输出要求（以空行开头，紧跟在问题后面）
+    PROMPT_OUTPUT_REQUIREMENTS = "\n".join([
+        "",
+        "## 输出要求（按优先级执行）",
+        "**优先级1**: 如果是封闭式问题（确认式/选择式/角色确认），直接简短回答",
+        "**优先级2**: 如果示例对话中有高度相关的回答，请优先引用或改写",
+        "**优先级3**: 如果是开放式问题，再适度融入学生档位特点",
+        "**格式要求**: 仅返回学生回答内容，不要额外解释，控制在50字以内。",
+        "",
+    ])
+
+    # TXT 日志：带时间戳的 RunCard 记录，分隔线 80 列
+    LOG_SEPARATOR = "-" * 80
+    RUN_CARD_LOG_TEMPLATE = "[{timestamp}] Step: {step_name} | step_id: {step_id}\n请求载荷: {payload}\n响应内容: {response}\n" + LOG_SEPARATOR
+
+    # 对话历史去重：超过该轮数后省略近似重复的旧轮次，最近几轮保留原文
+    HISTORY_DEDUP_MIN_TURNS = 20
+    HISTORY_KEEP_RECENT = 5
+    HISTORY_DEDUP_SIMILARITY = 0.9
+
     def __init__(self, base_url="https://cloudapi.polymas.com"):
         super().__init__(base_url)
+        log.setLevel(getattr(logging, (_env("LOG_LEVEL") or "INFO").upper(), logging.INFO))
 
         # Provide profile data for base prompt/selection helpers.
         self.student_profiles = self.STUDENT_PROFILES
@@ -661,15 +1136,62 @@ class WorkflowTester(WorkflowTesterBase):
         self.llm_api_key = os.getenv("LLM_API_KEY", "")
         self.llm_model = os.getenv("LLM_MODEL", "Doubao-1.5-pro-32k")
         self.llm_service_code = os.getenv("LLM_SERVICE_CODE", "SI_Ability")
+        # 复用 LLM 连接（keep-alive），避免每轮重新建立 TCP/TLS 连接
+        self.llm_session = mount_http_adapter(requests.Session())
+        # LLM_STREAM=1 时流式接收回答，边生成边打印
+        self.llm_stream = os.getenv("LLM_STREAM") == "1"
+        # 本次回答是否已流式打印过，已打印时不再重复输出整段回答
+        self._answer_streamed = False
+        # 封闭式问题（CLOSED_FORM_SHORTCUT=1 启用）：命中规则时跳过大模型
+        self.closed_form_shortcut = os.getenv("CLOSED_FORM_SHORTCUT") == "1"
+
+        # 提示词中与问题无关的前缀（角色设定/问题类型/示例对话/知识库），按输入懒重建
+        self._prompt_prefix_key = None
+        self._prompt_prefix = ""
+        # 已渲染的对话历史（每轮一段），随 conversation_history 增量追加
+        self._history_parts: List[str] = []
+        self._history_dup: List[bool] = []
+        self._history_kept_keys: List[Tuple[str, str]] = []
+        self._history_source: Optional[List[Dict[str, str]]] = None
 
         # 回放模式相关属性
         self.replay_engine = None
         self.use_replay_mode = False
         self.similarity_threshold = 0.7
         self.replay_log_path = None
+        # 最近一次 generate_answer_with_replay 的结果来源，供打印使用
+        self._last_match: Dict = {"matched": False, "source": "Doubao"}
+
+        # 语义缓存（SEMANTIC_CACHE=1 启用）：近似重复的提问直接复用已生成的回答
+        self.semantic_cache: Optional[SemanticAnswerCache] = None
+        # 语义缓存分区（档位 + 任务/知识库/示例对话摘要），输入变化时重算
+        self._cache_scope_key = None
+        self._cache_scope = ""
+        if os.getenv("SEMANTIC_CACHE") == "1":
+            self._initialize_semantic_cache()
 
         self._initialize_doubao_client()
 
+    def _initialize_semantic_cache(self):
+        """初始化语义缓存，并加载上次运行保存的条目"""
+        api_key = os.getenv("EMBEDDING_API_KEY") or os.getenv("ARK_API_KEY")
+        if not api_key:
+            print("⚠️  警告: 未设置 EMBEDDING_API_KEY，语义缓存未启用")
+            return
+
+        try:
+            threshold = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+        except ValueError:
+            threshold = 0.9
+        embed_client = EmbeddingClient(
+            api_key=api_key,
+            base_url=os.getenv("EMBEDDING_BASE_URL", "https://llm-service.polymas.com/api/openai/v1"),
+            model=os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"),
+        )
+        self.semantic_cache = SemanticAnswerCache(self.log_root / "semantic_cache", embed_client, threshold)
+        loaded = self.semantic_cache.load()
+        print(f"💾 语义缓存已启用 (阈值: {threshold}，已加载 {loaded} 条)")
+
     def _initialize_doubao_client(self):
         """初始化 Doubao 客户端"""
         print(f"🔧 模型类型: {self.model_type}")
@@ -688,6 +1210,8 @@ class WorkflowTester(WorkflowTesterBase):
 
             if api_key:
                 try:
+                    from openai import OpenAI  # 仅 SDK 模式需要，按需导入
+
                     self.doubao_client = OpenAI(api_key=api_key, base_url=base_url)
                     print(f"   - 使用 Doubao OpenAI SDK 调用模式")
                     print(f"   - Model: {self.doubao_model}")
@@ -717,16 +1241,22 @@ class WorkflowTester(WorkflowTesterBase):
             "frequency_penalty": 0.3,
             "presence_penalty": 0.2
         }
+        if self.llm_stream:
+            payload["stream"] = True
 
         try:
-            response = requests.post(
+            # with 块结束时关闭响应，流式读取中途退出也会把连接归还给连接池
+            with self.llm_session.post(
                 self.llm_api_url,
                 headers=headers,
                 json=payload,
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()
+                timeout=30,
+                stream=self.llm_stream,
+            ) as response:
+                response.raise_for_status()
+                if self.llm_stream:
+                    return self._collect_stream(self._iter_sse_deltas(response)).strip()
+                result = response.json()
             return result["choices"][0]["message"]["content"].strip()
         except requests.exceptions.RequestException as e:
             print(f"❌ HTTP POST 调用失败: {str(e)}")
@@ -735,13 +1265,39 @@ class WorkflowTester(WorkflowTesterBase):
             print(f"❌ 解析响应失败: {str(e)}")
             return None
 
-    def _retry_request(self, request_func, *args, **kwargs):
+    @staticmethod
+    def _iter_sse_deltas(response):
+        """逐行解析 SSE 响应（data: {...}），产出每个分片的增量文本"""
+        for raw in response.iter_lines():
+            if not raw or not raw.startswith(b"data:"):
+                continue
+            data = raw[5:].strip()
+            if data == b"[DONE]":
+                break
+            choices = _loads(data).get("choices") or []
+            if choices:
+                yield (choices[0].get("delta") or {}).get("content")
+
+    @staticmethod
+    def _collect_stream(deltas) -> str:
+        """拼接流式分片，同时实时打印已生成的内容"""
+        parts = []
+        for delta in deltas:
+            if delta:
+                parts.append(delta)
+                print(delta, end="", flush=True)
+        if parts:
+            print()
+        return "".join(parts)
+
+    def _retry_request(self, request_func, *args, quiet: bool = True, **kwargs):
         """
         通用重试机制
 
         Args:
             request_func: 要执行的请求函数
             *args, **kwargs: 传递给请求函数的参数
+            quiet: 为 True 时首次请求不打印提示，仅在重试/失败时输出
 
         Returns:
             请求结果
@@ -755,7 +1311,8 @@ class WorkflowTester(WorkflowTesterBase):
                 if 'timeout' in kwargs:
                     kwargs['timeout'] = timeout
 
-                print(f"🔄 尝试第 {attempt + 1}/{self.max_retries} 次请求 (超时: {timeout}秒)...")
+                if attempt > 0 or not quiet:
+                    print(f"🔄 尝试第 {attempt + 1}/{self.max_retries} 次请求 (超时: {timeout}秒)...")
 
                 result = request_func(*args, **kwargs)
 
@@ -786,26 +1343,15 @@ class WorkflowTester(WorkflowTesterBase):
 
     def _post_json(self, url: str, payload: Dict, timeout: int):
         """Override base POST to add retries."""
-        def make_request():
-            return self.session.post(
-                url,
-                json=payload,
-                headers=self.headers,
-                timeout=timeout,
-            )
-        return self._retry_request(make_request)
+        # 只编码一次请求（URL / 头部 / JSON 体），每次重试直接发送
+        prepared = self.session.prepare_request(
+            requests.Request("POST", url, json=payload, headers=self.headers)
+        )
+        send_kwargs = self.session.merge_environment_settings(prepared.url, {}, None, None, None)
 
-    def _log_run_card(self, step_id, payload, response_data):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        step_name = self._get_step_display_name(step_id)
-        # 同时记录 step_name 和 step_id，便于阅读和回放
-        log_lines = [
-            f"[{timestamp}] Step: {step_name} | step_id: {step_id}",
-            f"请求载荷: {json.dumps(payload, ensure_ascii=False)}",
-            f"响应内容: {json.dumps(response_data, ensure_ascii=False)}",
-            "-" * 80,
-        ]
-        self._append_log(self.run_card_log_path, "\n".join(log_lines))
+        def make_request(timeout=timeout):
+            return self.session.send(prepared, timeout=timeout, **send_kwargs)
+        return self._retry_request(make_request, timeout=timeout)
 
     def _log_dialogue_entry(self, step_id, user_text=None, ai_text=None, source="chat"):
         if user_text is None and ai_text is None:
@@ -820,20 +1366,22 @@ class WorkflowTester(WorkflowTesterBase):
             lines.append(f"用户: {user_text}")
         if ai_text:
             lines.append(f"AI: {ai_text}")
-        lines.append("-" * 80)
+        lines.append(self.LOG_SEPARATOR)
         self._append_log(self.dialogue_log_path, "\n".join(lines))
 
         # Collect JSON stage data when enabled (base hook).
-        if user_text:
-            try:
-                self._collect_stage_data(step_id, self.dialogue_round, "user", user_text)
-            except Exception:
-                pass
-        if ai_text:
+        try:
+            self._collect_stage_data_pair(step_id, self.dialogue_round, user_text, ai_text)
+        except Exception:
+            pass
+
+    def _finalize_workflow(self):
+        super()._finalize_workflow()
+        if self.semantic_cache:
             try:
-                self._collect_stage_data(step_id, self.dialogue_round, "assistant", ai_text)
-            except Exception:
-                pass
+                self.semantic_cache.save()
+            except Exception as e:
+                print(f"⚠️  警告: 语义缓存保存失败: {str(e)}")
 
     def enable_replay_mode(self, log_path: str, similarity_threshold: float = 0.7):
         """
@@ -884,8 +1432,9 @@ class WorkflowTester(WorkflowTesterBase):
         Returns:
             用户回答
         """
+        self._last_match = {"matched": False, "source": "Doubao"}
         if not self.use_replay_mode or not self.replay_engine:
-            print("⚠️  未启用回放模式，使用模型生成回答")
+            log.warning("⚠️  未启用回放模式，使用模型生成回答")
             return self.generate_answer_with_doubao(question)
 
         # 尝试从日志中获取匹配的回答
@@ -893,112 +1442,195 @@ class WorkflowTester(WorkflowTesterBase):
         matched_answer = self.replay_engine.get_answer(question, step_id=step_id)
 
         if matched_answer:
-            print(f"🎯 使用日志回答 (相似度匹配)")
+            log.info(f"🎯 使用日志回答 (相似度匹配)")
+            self._last_match = {"matched": True, "source": "日志"}
             return matched_answer
         else:
-            print("🔍 未找到匹配的日志回答，使用模型生成")
+            log.info("🔍 未找到匹配的日志回答，使用模型生成")
             return self.generate_answer_with_doubao(question)
 
+    def _semantic_cache_scope(self) -> str:
+        """语义缓存分区：档位 + 任务 / 知识库 / 示例对话的摘要，跨课程不复用回答"""
+        key = (
+            self.student_profile_key or self.DEFAULT_PROFILE_KEY,
+            self.task_id,
+            self.knowledge_base_content,
+            self.dialogue_samples_content,
+        )
+        if key != self._cache_scope_key:
+            self._cache_scope = SemanticAnswerCache.make_scope(*key)
+            self._cache_scope_key = key
+        return self._cache_scope
+
+    def _get_static_prompt_prefix(self) -> str:
+        """返回提示词静态前缀；档位、示例对话或知识库变化时才重新拼接"""
+        # 内容未变时元组比较命中对象同一性，开销为 O(1)
+        key = (self.student_profile_key, self.dialogue_samples_content, self.knowledge_base_content)
+        if key == self._prompt_prefix_key:
+            return self._prompt_prefix
+
+        profile_info = self._get_student_profile_info()
+        sections = [
+            "## 角色设定",
+            f"学生档位: {profile_info['label']}",
+            f"角色特征: {profile_info['description']}",
+            f"表达风格: {profile_info['style']}",
+            "",
+            self.PROMPT_QUESTION_TYPES,
+        ]
+
+        if self.dialogue_samples_content:
+            sections.extend([
+                "## 档位示例对话 (如有匹配请优先引用或改写，优先级最高)",
+                self.dialogue_samples_content,
+                "",
+            ])
+
+        if self.knowledge_base_content:
+            sections.extend([
+                "## 参考知识库 (可结合使用)",
+                self.knowledge_base_content,
+                "",
+            ])
+
+        self._prompt_prefix = "\n".join(sections)
+        self._prompt_prefix_key = key
+        return self._prompt_prefix
+
+    def _render_history(self) -> str:
+        """
+        渲染对话历史，只格式化上次渲染之后新增的轮次
+
+        历史超过 HISTORY_DEDUP_MIN_TURNS 轮后，省略与更早轮次近似重复的对话
+        （最近 HISTORY_KEEP_RECENT 轮始终保留原文），避免提示词随轮数线性膨胀。
+        """
+        history = self.conversation_history
+        if history is not self._history_source or len(self._history_parts) > len(history):
+            # 历史被重置（新工作流）或截断时从头渲染
+            self._history_parts = []
+            self._history_dup = []
+            self._history_kept_keys = []
+            self._history_source = history
+        for i in range(len(self._history_parts), len(history)):
+            turn = history[i]
+            self._history_parts.append(
+                f"第{i + 1}轮:\n  AI提问: {turn['ai']}\n  学生回答: {turn['student']}"
+            )
+            self._history_dup.append(self._is_duplicate_turn(turn))
+
+        total = len(self._history_parts)
+        if total <= self.HISTORY_DEDUP_MIN_TURNS:
+            return "\n".join(self._history_parts)
+
+        recent_start = total - self.HISTORY_KEEP_RECENT
+        kept = [
+            part for i, part in enumerate(self._history_parts)
+            if i >= recent_start or not self._history_dup[i]
+        ]
+        omitted = total - len(kept)
+        if omitted:
+            kept.insert(0, f"（已省略 {omitted} 轮与前文重复的对话）")
+        return "\n".join(kept)
+
+    def _is_duplicate_turn(self, turn: Dict[str, str]) -> bool:
+        """判断该轮是否与之前保留的某一轮重复（提问近似且回答相同）；不重复时记入已保留列表"""
+        ai_key = DialogueMatcher._normalize(turn['ai'])
+        student_key = DialogueMatcher._normalize(turn['student'])
+        threshold = self.HISTORY_DEDUP_SIMILARITY
+        for kept_ai, kept_student in self._history_kept_keys:
+            if kept_student == student_key and DialogueMatcher._score(ai_key, kept_ai, score_cutoff=threshold) >= threshold:
+                return True
+        self._history_kept_keys.append((ai_key, student_key))
+        return False
+
+    def _log_generated_answer(self, answer: str, source: str = "Doubao", leading_newline: bool = False):
+        """输出生成的回答；流式模式下回答已边生成边打印，不再重复输出"""
+        streamed, self._answer_streamed = self._answer_streamed, False
+        if streamed:
+            return
+        prefix = "\n" if leading_newline else ""
+        log.info(f"{prefix}🤖 {source} 生成的回答: {answer}")
+
     def generate_answer_with_doubao(self, question):
         """使用 Doubao 模型生成回答"""
+        self._answer_streamed = False
+        if self.closed_form_shortcut and question:
+            shortcut = _closed_form_answer(question)
+            if shortcut:
+                log.info(f"⚡ 识别为封闭式问题，直接回答: {shortcut}")
+                return shortcut
+
         # 检查是否有可用的调用方式
         if self.model_type == "doubao_sdk" and not self.doubao_client:
-            print("❌ Doubao 客户端未初始化")
+            log.error("❌ Doubao 客户端未初始化")
             return None
         elif self.model_type == "doubao_post" and not self.llm_api_url:
-            print("❌ POST API URL 未配置")
+            log.error("❌ POST API URL 未配置")
             return None
 
-        try:
-            profile_info = self._get_student_profile_info()
-            system_prompt = (
-                "你是一名能力训练助手，需要严格按照给定的学生档位扮演角色。"
-            )
-
-            sections = [
-                "## 角色设定",
-                f"学生档位: {profile_info['label']}",
-                f"角色特征: {profile_info['description']}",
-                f"表达风格: {profile_info['style']}",
-                "",
-            ]
-
-            # 添加问题类型识别（优先级最高）
-            sections.extend([
-                "## 问题类型识别（优先级最高）",
-                "如果当前问题属于以下类型，请优先直接回答，不需要强制体现性格特点：",
-                "1. **确认式问题**: 如'你准备好了吗？请回复是或否'、'确认的话请回复是'",
-                "   → 直接回答'是'、'好的'、'确认'等",
-                "2. **选择式问题**: 如'你选择A还是B？'、'请选择1/2/3'",
-                "   → 直接说出选项，如'我选择A'、'选1'",
-                "3. **角色确认问题**: 如'你是学生还是老师？'",
-                "   → 直接回答角色，如'学生'",
-                "",
-                "**判断标准**: 如果问题中包含'请回复'、'请选择'、'是或否'、'A/B/C'等明确指示，则为封闭式问题。",
-                "",
-            ])
-
-            if self.dialogue_samples_content:
-                sections.extend([
-                    "## 档位示例对话 (如有匹配请优先引用或改写，优先级最高)",
-                    self.dialogue_samples_content,
-                    "",
-                ])
+        cache_scope = self._semantic_cache_scope() if self.semantic_cache else None
+        if self.semantic_cache:
+            try:
+                cached_answer = self.semantic_cache.lookup(cache_scope, question)
+            except Exception as e:
+                log.warning(f"⚠️  语义缓存查询失败: {str(e)}")
+                cached_answer = None
+            if cached_answer:
+                log.info("💾 命中语义缓存，复用已生成的回答")
+                return cached_answer
 
-            if self.knowledge_base_content:
-                sections.extend([
-                    "## 参考知识库 (可结合使用)",
-                    self.knowledge_base_content,
-                    "",
-                ])
+        try:
+            buf = io.StringIO()
+            buf.write(self._get_static_prompt_prefix())
+            buf.write("\n")
 
             # 添加对话历史
             if self.conversation_history:
-                sections.extend([
-                    "## 对话历史（按时间顺序）",
-                ])
-                for i, turn in enumerate(self.conversation_history, 1):
-                    sections.append(f"第{i}轮:")
-                    sections.append(f"  AI提问: {turn['ai']}")
-                    sections.append(f"  学生回答: {turn['student']}")
-                sections.append("")
+                buf.write("## 对话历史（按时间顺序）\n")
+                buf.write(self._render_history())
+                buf.write("\n\n")
 
-            sections.extend([
-                "## 当前问题",
-                question,
-                "",
-                "## 输出要求（按优先级执行）",
-                "**优先级1**: 如果是封闭式问题（确认式/选择式/角色确认），直接简短回答",
-                "**优先级2**: 如果示例对话中有高度相关的回答，请优先引用或改写",
-                "**优先级3**: 如果是开放式问题，再适度融入学生档位特点",
-                "**格式要求**: 仅返回学生回答内容，不要额外解释，控制在50字以内。",
-                ""
-            ])
+            buf.write("## 当前问题\n")
+            buf.write(question)
+            buf.write("\n")
+            buf.write(self.PROMPT_OUTPUT_REQUIREMENTS)
 
-            user_message = "\n".join(sections)
+            user_message = buf.getvalue()
 
             messages = [
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": self.SYSTEM_PROMPT},
                 {"role": "user", "content": user_message}
             ]
 
             # 根据配置选择调用方式
             if self.model_type == "doubao_post":
-                print("🔄 使用 Doubao POST API 调用...")
+                log.debug("🔄 使用 Doubao POST API 调用...")
                 answer = self._call_doubao_post(messages, temperature=0.7, max_tokens=1000)
             else:  # doubao_sdk
-                print("🔄 使用 Doubao OpenAI SDK 调用...")
+                log.debug("🔄 使用 Doubao OpenAI SDK 调用...")
                 response = self.doubao_client.chat.completions.create(
                     model=self.doubao_model,
                     messages=messages,
                     temperature=0.7,
-                    top_p=0.9
+                    top_p=0.9,
+                    stream=self.llm_stream,
                 )
-                answer = response.choices[0].message.content
+                if self.llm_stream:
+                    answer = self._collect_stream(
+                        chunk.choices[0].delta.content for chunk in response if chunk.choices
+                    )
+                else:
+                    answer = response.choices[0].message.content
 
+            self._answer_streamed = bool(answer) and self.llm_stream
+            if answer and self.semantic_cache:
+                try:
+                    self.semantic_cache.add(cache_scope, question, answer)
+                except Exception as e:
+                    log.warning(f"⚠️  语义缓存写入失败: {str(e)}")
             return answer
         except Exception as e:
-            print(f"❌ 调用 {self.model_type} 模型失败: {str(e)}")
+            log.error(f"❌ 调用 {self.model_type} 模型失败: {str(e)}")
             return None
 
     def run_semi_interactive(self, task_id, breakpoint_round: int = 0):
@@ -1023,127 +1655,121 @@ class WorkflowTester(WorkflowTesterBase):
             self.student_profile_key = "good"
 
         try:
-            self.start_workflow(task_id)
-            round_num = 1
-            auto_continue = False  # 是否进入全自动模式
-            current_breakpoint = breakpoint_round  # 当前断点轮数
-
-            while True:
-                if self.current_step_id is None:
-                    print("\n✅ 工作流完成！没有更多步骤了。")
-                    break
+            with self._workflow_session(task_id):
+                round_num = 1
+                auto_continue = False  # 是否进入全自动模式
+                current_breakpoint = breakpoint_round  # 当前断点轮数
+
+                while True:
+                    if self.current_step_id is None:
+                        log.info("\n✅ 工作流完成！没有更多步骤了。")
+                        break
 
-                if round_num > 80:
-                    print(f"\n⚠️  警告：已达到最大对话轮数（{round_num}轮），自动退出防止无限循环")
-                    break
+                    if round_num > 80:
+                        log.warning(f"\n⚠️  警告：已达到最大对话轮数（{round_num}轮），自动退出防止无限循环")
+                        break
 
-                print("\n" + "=" * 60)
-                mode_label = "全自动模式" if auto_continue else "半交互模式"
-                print(f"💬 第 {round_num} 轮对话（{mode_label}）")
-                print("=" * 60)
+                    log.info("\n" + "=" * 60)
+                    mode_label = "全自动模式" if auto_continue else "半交互模式"
+                    log.info(f"💬 第 {round_num} 轮对话（{mode_label}）")
+                    log.info("=" * 60)
 
-                if auto_continue:
-                    # 检查是否到达断点
-                    if current_breakpoint > 0 and round_num >= current_breakpoint:
-                        print(f"\n🔴 到达断点（第 {current_breakpoint} 轮），切回半交互模式")
-                        auto_continue = False
-                        current_breakpoint = 0  # 清除断点
-                        # 不 continue，继续走下面的半交互逻辑
-                    else:
-                        # 全自动模式：直接让模型生成回答
-                        bp_info = f"（断点: 第 {current_breakpoint} 轮）" if current_breakpoint > 0 else ""
-                        print(f"\n🤖 正在使用 Doubao 生成回答...{bp_info}")
-                        answer = self.generate_answer_with_doubao(self.question_text)
-                        if not answer:
-                            print("❌ 无法生成回答，退出自动模式")
+                    if auto_continue:
+                        # 检查是否到达断点
+                        if current_breakpoint > 0 and round_num >= current_breakpoint:
+                            log.info(f"\n🔴 到达断点（第 {current_breakpoint} 轮），切回半交互模式")
                             auto_continue = False
-                            continue
-                        print(f"🤖 Doubao 生成的回答: {answer}")
-
-                if not auto_continue:
-                    # 半交互模式：等待用户输入
-                    print("\n提示：回车=AI回答 | 输入内容=手动回答 | continue [N]=全自动(可选断点) | quit=退出")
-                    user_input = input("请输入你的回答: ").strip()
-
-                    if user_input.lower() == "quit":
-                        print("👋 用户主动退出")
-                        break
-
-                    if user_input.lower().startswith("continue"):
-                        # 解析是否带断点参数: "continue" 或 "continue 10"
-                        parts = user_input.split()
-                        if len(parts) >= 2:
-                            try:
-                                current_breakpoint = int(parts[1])
-                                if current_breakpoint <= round_num:
-                                    print(f"⚠️  断点必须大于当前轮数（{round_num}），已忽略断点设置")
+                            current_breakpoint = 0  # 清除断点
+                            # 不 continue，继续走下面的半交互逻辑
+                        else:
+                            # 全自动模式：直接让模型生成回答
+                            bp_info = f"（断点: 第 {current_breakpoint} 轮）" if current_breakpoint > 0 else ""
+                            log.info(f"\n🤖 正在使用 Doubao 生成回答...{bp_info}")
+                            answer = self.generate_answer_with_doubao(self.question_text)
+                            if not answer:
+                                log.error("❌ 无法生成回答，退出自动模式")
+                                auto_continue = False
+                                continue
+                            self._log_generated_answer(answer)
+
+                    if not auto_continue:
+                        # 半交互模式：等待用户输入
+                        print("\n提示：回车=AI回答 | 输入内容=手动回答 | continue [N]=全自动(可选断点) | quit=退出")
+                        user_input = input("请输入你的回答: ").strip()
+
+                        if user_input.lower() == "quit":
+                            log.info("👋 用户主动退出")
+                            break
+
+                        if user_input.lower().startswith("continue"):
+                            # 解析是否带断点参数: "continue" 或 "continue 10"
+                            parts = user_input.split()
+                            if len(parts) >= 2:
+                                try:
+                                    current_breakpoint = int(parts[1])
+                                    if current_breakpoint <= round_num:
+                                        log.warning(f"⚠️  断点必须大于当前轮数（{round_num}），已忽略断点设置")
+                                        current_breakpoint = 0
+                                    else:
+                                        log.info(f"\n🚀 进入全自动模式，将在第 {current_breakpoint} 轮后暂停...")
+                                except ValueError:
+                                    log.warning(f"⚠️  无效的断点数字: {parts[1]}，将持续全自动运行")
                                     current_breakpoint = 0
-                                else:
-                                    print(f"\n🚀 进入全自动模式，将在第 {current_breakpoint} 轮后暂停...")
-                            except ValueError:
-                                print(f"⚠️  无效的断点数字: {parts[1]}，将持续全自动运行")
+                            else:
                                 current_breakpoint = 0
+                                log.info("\n🚀 进入全自动模式，后续将由 AI 自动回答...")
+
+                            auto_continue = True
+                            # 本轮也自动回答
+                            log.info(f"\n🤖 正在使用 Doubao 生成回答...")
+                            answer = self.generate_answer_with_doubao(self.question_text)
+                            if not answer:
+                                log.error("❌ 无法生成回答，请手动输入")
+                                auto_continue = False
+                                continue
+                            self._log_generated_answer(answer)
+                        elif user_input:
+                            # 用户有输入，使用用户的回答
+                            log.info(f"\n👤 使用用户回答: {user_input}")
+                            answer = user_input
                         else:
-                            current_breakpoint = 0
-                            print("\n🚀 进入全自动模式，后续将由 AI 自动回答...")
-
-                        auto_continue = True
-                        # 本轮也自动回答
-                        print(f"\n🤖 正在使用 Doubao 生成回答...")
-                        answer = self.generate_answer_with_doubao(self.question_text)
-                        if not answer:
-                            print("❌ 无法生成回答，请手动输入")
-                            auto_continue = False
-                            continue
-                        print(f"🤖 Doubao 生成的回答: {answer}")
-                    elif user_input:
-                        # 用户有输入，使用用户的回答
-                        print(f"\n👤 使用用户回答: {user_input}")
-                        answer = user_input
-                    else:
-                        # 用户直接回车，使用 Doubao 生成回答
-                        print(f"\n🤖 正在使用 Doubao 生成回答...")
-                        answer = self.generate_answer_with_doubao(self.question_text)
-                        if not answer:
-                            print("❌ 无法生成回答，请手动输入")
-                            continue
-                        print(f"🤖 Doubao 生成的回答: {answer}")
-
-                # 保存当前轮对话到历史
-                self.conversation_history.append({
-                    "ai": self.question_text,
-                    "student": answer
-                })
+                            # 用户直接回车，使用 Doubao 生成回答
+                            log.info(f"\n🤖 正在使用 Doubao 生成回答...")
+                            answer = self.generate_answer_with_doubao(self.question_text)
+                            if not answer:
+                                log.error("❌ 无法生成回答，请手动输入")
+                                continue
+                            self._log_generated_answer(answer)
+
+                    # 保存当前轮对话到历史
+                    self.conversation_history.append({
+                        "ai": self.question_text,
+                        "student": answer
+                    })
 
-                # 发送回答
-                try:
-                    result = self.chat(answer)
-                except Exception as e:
-                    print(f"\n⚠️  发送回答失败: {str(e)}")
-                    break
+                    # 发送回答
+                    try:
+                        result = self.chat(answer)
+                    except Exception as e:
+                        log.warning(f"\n⚠️  发送回答失败: {str(e)}")
+                        break
 
-                # 检查返回结果
-                data = (result or {}).get("data") or {}
-                if data.get("text") is None and data.get("nextStepId") is None:
-                    print("\n✅ 工作流完成！")
-                    break
+                    # 检查返回结果
+                    data = (result or {}).get("data") or {}
+                    if data.get("text") is None and data.get("nextStepId") is None:
+                        log.info("\n✅ 工作流完成！")
+                        break
 
-                round_num += 1
-                time.sleep(0.5)
+                    round_num += 1
 
-            print("\n" + "=" * 60)
-            print("🎉 工作流测试结束")
-            print("=" * 60)
+                print("\n" + "=" * 60)
+                print("🎉 工作流测试结束")
+                print("=" * 60)
 
         except Exception as e:
             print(f"\n❌ 错误: {str(e)}")
             import traceback
             traceback.print_exc()
-        finally:
-            try:
-                self._finalize_workflow()
-            except Exception:
-                pass
 
     def run_with_doubao(self, task_id):
         """
@@ -1158,76 +1784,65 @@ class WorkflowTester(WorkflowTesterBase):
             self.student_profile_key = "medium"
 
         try:
-            # 启动工作流
-            self.start_workflow(task_id)
-
-            round_num = 1
-
-            # 循环对话
-            while True:
-                # 检查是否还有下一步
-                if self.current_step_id is None:
-                    print("\n✅ 工作流完成！没有更多步骤了。")
-                    break
+            with self._workflow_session(task_id):
+                round_num = 1
+
+                # 循环对话
+                while True:
+                    # 检查是否还有下一步
+                    if self.current_step_id is None:
+                        log.info("\n✅ 工作流完成！没有更多步骤了。")
+                        break
 
-                # 安全检查：防止无限循环
-                if round_num > 80:
-                    print(f"\n⚠️  警告：已达到最大对话轮数（{round_num}轮），自动退出防止无限循环")
-                    break
+                    # 安全检查：防止无限循环
+                    if round_num > 80:
+                        log.warning(f"\n⚠️  警告：已达到最大对话轮数（{round_num}轮），自动退出防止无限循环")
+                        break
 
-                print("\n" + "="*60)
-                mode = "日志回放" if self.use_replay_mode else "Doubao 自主回答"
-                print(f"🤖 第 {round_num} 轮对话（{mode}）")
-                print("="*60)
+                    log.info("\n" + "="*60)
+                    mode = "日志回放" if self.use_replay_mode else "Doubao 自主回答"
+                    log.info(f"🤖 第 {round_num} 轮对话（{mode}）")
+                    log.info("="*60)
 
-                # 使用回放模式或 Doubao 生成回答
-                print(f"\n🔄 正在生成回答...")
-                generated_answer = self.generate_answer_with_replay(self.question_text)
+                    # 使用回放模式或 Doubao 生成回答
+                    log.debug(f"\n🔄 正在生成回答...")
+                    generated_answer = self.generate_answer_with_replay(self.question_text)
 
-                if not generated_answer:
-                    print("❌ 无法生成回答，跳过此轮")
-                    break
+                    if not generated_answer:
+                        log.error("❌ 无法生成回答，跳过此轮")
+                        break
 
-                step_id = getattr(self, "current_step_id", None)
-                source = "日志" if self.use_replay_mode and self.replay_engine and self.replay_engine.get_match_info(self.question_text, step_id=step_id).get("matched") else "Doubao"
-                print(f"\n🤖 {source} 生成的回答: {generated_answer}")
+                    self._log_generated_answer(generated_answer, self._last_match["source"], leading_newline=True)
 
-                # 保存当前轮对话到历史
-                self.conversation_history.append({
-                    "ai": self.question_text,
-                    "student": generated_answer
-                })
+                    # 保存当前轮对话到历史
+                    self.conversation_history.append({
+                        "ai": self.question_text,
+                        "student": generated_answer
+                    })
 
-                # 发送生成的回答
-                try:
-                    result = self.chat(generated_answer)
-                except Exception as e:
-                    print(f"\n⚠️  发送回答失败: {str(e)}")
-                    break
+                    # 发送生成的回答
+                    try:
+                        result = self.chat(generated_answer)
+                    except Exception as e:
+                        log.warning(f"\n⚠️  发送回答失败: {str(e)}")
+                        break
 
-                # 检查返回结果，如果 text 为 null 且 nextStepId 为 null，代表输出结束
-                data = (result or {}).get("data") or {}
-                if data.get("text") is None and data.get("nextStepId") is None:
-                    print("\n✅ 工作流完成！")
-                    break
+                    # 检查返回结果，如果 text 为 null 且 nextStepId 为 null，代表输出结束
+                    data = (result or {}).get("data") or {}
+                    if data.get("text") is None and data.get("nextStepId") is None:
+                        log.info("\n✅ 工作流完成！")
+                        break
 
-                round_num += 1
-                time.sleep(1)  # 稍微延迟，避免请求过快
+                    round_num += 1
 
-            print("\n" + "="*60)
-            print("🎉 工作流测试结束")
-            print("="*60)
+                print("\n" + "="*60)
+                print("🎉 工作流测试结束")
+                print("="*60)
 
         except Exception as e:
             print(f"\n❌ 错误: {str(e)}")
             import traceback
             traceback.print_exc()
-        finally:
-            # Ensure JSON logs are written even if the last round errors out.
-            try:
-                self._finalize_workflow()
-            except Exception:
-                pass
 
 
 # 主程序
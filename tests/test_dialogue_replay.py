@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+
+from auto_script_train import DialogueMatcher, DialogueReplayEngine
+
+LOG_TEXT = """[2025-11-28 16:01:21] Step: 开场 | step_id: s1 | 第 1 轮 | 来源: runCard
+AI: 你好，请问你准备好了吗？
+--------------------------------------------------------------------------------
+[2025-11-28 16:01:23] Step: 开场 | step_id: s1 | 第 1 轮 | 来源: chat
+用户: 准备好了
+AI: 请介绍一下你自己
+--------------------------------------------------------------------------------
+"""
+
+
+class DialogueReplayEmptyQuestionTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.log_path = tempfile.mkstemp(suffix=".txt")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(LOG_TEXT)
+        self.engine = DialogueReplayEngine(self.log_path)
+        self.assertTrue(self.engine.load_log())
+
+    def tearDown(self):
+        os.remove(self.log_path)
+
+    def test_matches_logged_question(self):
+        self.assertEqual(self.engine.get_answer("你好，请问你准备好了吗？", "s1"), "准备好了")
+
+    def test_none_or_empty_question_is_no_match(self):
+        for question in (None, "", "   "):
+            with self.subTest(question=question):
+                self.assertIsNone(self.engine.get_answer(question, "s1"))
+                info = self.engine.get_match_info(question, "s1")
+                self.assertFalse(info["matched"])
+                self.assertEqual(info["similarity"], 0.0)
+
+    def test_best_candidate_without_question(self):
+        pairs = [{"ai": "你好", "user": "好"}]
+        self.assertEqual(DialogueMatcher().best_candidate(None, pairs), (None, 0.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,199 @@
+import atexit
+import contextlib
+import functools
 import json
 import os
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import requests
-from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # optional; stdlib json is used when missing
+    orjson = None
+
+
+def _dumpb(obj: Any, pretty: bool = False) -> bytes:
+    """Serialize to UTF-8 JSON bytes (non-ASCII kept), using orjson when available."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        try:
+            return orjson.dumps(obj, option=option)
+        except TypeError:  # e.g. non-str keys orjson cannot coerce; stdlib handles them
+            pass
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _dumps(obj: Any, pretty: bool = False) -> str:
+    """Serialize to a JSON str (non-ASCII kept), using orjson when available."""
+    return _dumpb(obj, pretty).decode("utf-8")
+
+
+# Parses str or bytes; use on response.content to skip requests' text decoding.
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+_dotenv_loaded = False
+
+
+def _load_dotenv_once():
+    """Parse .env on first use only; values already in os.environ win, so later calls are no-ops."""
+    global _dotenv_loaded
+    if _dotenv_loaded:
+        return
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    _dotenv_loaded = True
+
+
+@functools.lru_cache(maxsize=None)
+def _env(key: str) -> Optional[str]:
+    """os.getenv memoized per process; only read after _load_dotenv_once() has run."""
+    return os.getenv(key)
+
+
+@functools.lru_cache(maxsize=1)
+def _custom_headers() -> Dict[str, Any]:
+    """CUSTOM_HEADERS parsed once per process. Shared dict: copy it, never mutate it."""
+    raw = _env("CUSTOM_HEADERS")
+    if not raw:
+        return {}
+    try:
+        extra_headers = _loads(raw)
+    except ValueError:
+        print("⚠️  警告: CUSTOM_HEADERS 格式不正确，已忽略")
+        return {}
+    if not isinstance(extra_headers, dict):
+        print("⚠️  警告: CUSTOM_HEADERS 必须是 JSON 对象，已忽略")
+        return {}
+    return extra_headers
+
+
+class AIMDRateLimiter:
+    """Pacing between backend calls that only slows down when the backend pushes back.
+
+    The delay starts at zero. A throttled response (429/503) doubles it, or jumps to
+    the server's Retry-After; each successful call shrinks it by a fixed step.
+    """
+
+    THROTTLE_STATUS = (429, 503)
+
+    def __init__(self, step: float = 0.5, max_delay: float = 30.0):
+        self.step = step
+        self.max_delay = max_delay
+        self.delay = 0.0
+
+    def wait(self):
+        if self.delay > 0:
+            time.sleep(self.delay)
+
+    def on_success(self):
+        self.delay = max(0.0, self.delay - self.step)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        backoff = self.delay * 2 if self.delay else self.step
+        self.delay = min(self.max_delay, max(backoff, retry_after or 0.0))
+
+    def observe(self, response: requests.Response):
+        """Update the delay from an HTTP response."""
+        if response.status_code not in self.THROTTLE_STATUS:
+            self.on_success()
+            return
+        try:
+            retry_after = float(response.headers.get("Retry-After", 0))
+        except ValueError:
+            retry_after = None
+        self.on_throttle(retry_after)
+
+
+def mount_http_adapter(
+    session: requests.Session,
+    pool_connections: int = 1,
+    pool_maxsize: int = 4,
+    max_retries: Optional[Retry] = None,
+) -> requests.Session:
+    """Mount one keep-alive pool on http:// and https://.
+
+    By default only connection failures are retried: the request never reached the
+    server, so this is safe even for non-idempotent POSTs such as chat.
+    """
+    if max_retries is None:
+        max_retries = Retry(total=3, connect=3, read=False, status=0, backoff_factor=0.3)
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=max_retries,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class _AsyncLogWriter:
+    """Writes log text on a daemon thread so disk I/O stays off the request path.
+
+    Items are (file, text) pairs consumed FIFO by a single worker, so per-file order
+    is preserved. Whatever is queued when the worker wakes up is written as one batch.
+    """
+
+    BATCH_SIZE = 64
+    _STOP = object()
+
+    def __init__(self):
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, f, text: str):
+        self._queue.put((f, text))
+
+    def stop(self):
+        """Write everything queued so far, then end the worker thread."""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = []
+            item = self._queue.get()
+            while item is not self._STOP:
+                batch.append(item)
+                if len(batch) >= self.BATCH_SIZE:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+            if item is self._STOP:
+                return
+
+    @staticmethod
+    def _write_batch(batch: List[Tuple[Any, Any]]):
+        # Join consecutive lines for the same file into a single write.
+        current, parts = None, []
+        for f, payload in batch + [(None, None)]:
+            if f is not current and parts:
+                try:
+                    current.write("".join(parts))
+                except (OSError, ValueError) as e:
+                    print(f"⚠️  警告: 日志写入失败: {str(e)}")
+                parts = []
+            current = f
+            if f is not None:
+                parts.append(payload)
 
 
 class WorkflowTesterBase:
@@ -22,10 +209,25 @@ class WorkflowTesterBase:
     DEFAULT_PROFILE_KEY: str = ""
     PROFILE_LABEL_FIELD_NAME: str = "学生档位"
     PROFILE_SELECT_TITLE: str = "学生档位"
+    THROTTLE_RETRIES: int = 5  # re-sends of a runCard/chat request answered with 429/503
+    LOG_BUFFER_LIMIT: int = 64 * 1024  # write buffer size of each open log file
+    LOG_HEADER_RULE: str = "=" * 60
+    LOG_SEPARATOR: str = "-" * 40
+    # Fields: timestamp, step_name, step_id, payload, response (unused fields are ignored)
+    RUN_CARD_LOG_TEMPLATE: str = "Step: {step_name} | step_id: {step_id}\n请求载荷: {payload}\n响应内容: {response}\n" + LOG_SEPARATOR
 
     def __init__(self, base_url: str = "https://cloudapi.polymas.com"):
         self.base_url = base_url
-        self.session = requests.Session()
+        self.session = mount_http_adapter(requests.Session())
+
+        # Backend request timeout in seconds (subclasses may override in __init__)
+        self.base_timeout = 60
+
+        # Small pool for independent backend queries issued side by side (created on first use)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        # Adaptive pacing for runCard/chat calls (no delay unless throttled)
+        self._rate_limiter = AIMDRateLimiter()
 
         # Workflow state
         self.session_id: Optional[str] = None
@@ -40,6 +242,12 @@ class WorkflowTesterBase:
         self.dialogue_log_path: Optional[Path] = None
         self.log_prefix: Optional[str] = None
         self.log_context_path: Optional[Path] = None
+        # ((task_id, profile key, context path, log root), log dir) of the last lookup
+        self._log_dir_cache: Optional[Tuple[Tuple[Any, ...], Path]] = None
+        # TXT log files stay open for the whole workflow; closed in _finalize_workflow / at exit.
+        # The writer thread exists only while log files are open.
+        self._log_files: Dict[Path, Any] = {}
+        self._log_writer: Optional[_AsyncLogWriter] = None
 
         # Log format / JSON logging (subclasses may enable)
         self.log_format: str = "txt"  # "txt" | "json" | "both"
@@ -51,43 +259,69 @@ class WorkflowTesterBase:
         # Student profiles
         self.student_profile_key: Optional[str] = None
         self.student_profiles: Dict[str, Dict[str, Any]] = {}
+        # (profile key, profiles dict, resolved info); recomputed only when either changes
+        self._profile_info_cache: Optional[Tuple[Optional[str], Dict[str, Dict[str, Any]], Dict[str, Any]]] = None
         self.dialogue_samples_content: Optional[str] = None
         self.knowledge_base_content: Optional[str] = None
         self.conversation_history: List[Dict[str, str]] = []
 
         # Step name mapping for nicer logs (optional)
         self.step_name_mapping: Dict[str, str] = {}
+        # Resolved display names; reset when the mapping is rebuilt or replaced
+        self._step_name_cache: Dict[str, str] = {}
+        self._step_name_cache_source: Optional[Dict[str, str]] = None
 
         # From environment
-        load_dotenv()
+        _load_dotenv_once()
         self.headers = {
             "Content-Type": "application/json",
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
         }
 
-        authorization = os.getenv("AUTHORIZATION")
-        cookie = os.getenv("COOKIE")
+        authorization = _env("AUTHORIZATION")
+        cookie = _env("COOKIE")
         if authorization:
             self.headers["Authorization"] = authorization
         if cookie:
             self.headers["Cookie"] = cookie
 
-        custom_headers = os.getenv("CUSTOM_HEADERS")
-        if custom_headers:
-            try:
-                extra_headers = json.loads(custom_headers)
-                if isinstance(extra_headers, dict):
-                    self.headers.update(extra_headers)
-                else:
-                    print("⚠️  警告: CUSTOM_HEADERS 必须是 JSON 对象，已忽略")
-            except json.JSONDecodeError:
-                print("⚠️  警告: CUSTOM_HEADERS 格式不正确，已忽略")
+        self.headers.update(_custom_headers())
+        # VERBOSE=1 prints request payloads to the console (the run-card log always has them)
+        self.verbose = _env("VERBOSE") == "1"
 
     # ---- Request helper ----
     def _post_json(self, url: str, payload: Dict[str, Any], timeout: int):
         """POST helper. Subclasses can override to add retries."""
         return self.session.post(url, json=payload, headers=self.headers, timeout=timeout)
 
+    @staticmethod
+    def _response_json(response) -> Any:
+        """Parse a response body straight from bytes; decode errors surface as RequestException."""
+        try:
+            return _loads(response.content)
+        except ValueError as e:
+            raise requests.exceptions.InvalidJSONError(str(e), response=response) from e
+
+    def _paced_post(self, url: str, payload: Dict[str, Any], timeout: int):
+        """POST through _post_json, waiting only when the backend has signalled throttling.
+
+        A throttled response (429/503) was not processed by the backend, so the same
+        request is re-sent after the grown delay, up to THROTTLE_RETRIES times.
+        """
+        limiter = self._rate_limiter
+        for attempt in range(self.THROTTLE_RETRIES + 1):
+            limiter.wait()
+            response = self._post_json(url, payload, timeout=timeout)
+            limiter.observe(response)
+            if response.status_code not in limiter.THROTTLE_STATUS:
+                break
+            if attempt < self.THROTTLE_RETRIES:
+                print(
+                    f"⏳ 服务端限流 (状态码: {response.status_code})，{limiter.delay:.1f} 秒后重试 "
+                    f"({attempt + 1}/{self.THROTTLE_RETRIES})"
+                )
+        return response
+
     # ---- Logging ----
     def _prepare_log_files(self, task_id: str):
         """Create log files (TXT/JSON) and write headers."""
@@ -98,7 +332,7 @@ class WorkflowTesterBase:
         log_dir.mkdir(parents=True, exist_ok=True)
         self.log_prefix = f"task_{task_id}_{timestamp.strftime('%Y%m%d_%H%M%S')}"
 
-        fmt = getattr(self, "log_format", "txt")
+        fmt = self.log_format
         if fmt in ["json", "both"]:
             self.json_log_enabled = True
             self.json_log_path = log_dir / f"{self.log_prefix}_dialogue.json"
@@ -121,42 +355,68 @@ class WorkflowTesterBase:
             ]
             if self.log_context_path:
                 header_lines.append(f"参考文档: {str(self.log_context_path)}")
-            header_lines.append("=" * 60)
+            header_lines.append(self.LOG_HEADER_RULE)
             header = "\n".join(header_lines) + "\n"
 
+            self._close_logs()
             for path, title in [
                 (self.run_card_log_path, "RunCard 信息记录"),
                 (self.dialogue_log_path, "对话记录"),
             ]:
-                with open(path, "w", encoding="utf-8") as f:
-                    f.write(title + "\n")
-                    f.write(header)
+                self._open_log(path, "w").writelines((title, "\n", header))
+
+    def _open_log(self, path: Path, mode: str = "a"):
+        f = open(path, mode, encoding="utf-8", buffering=self.LOG_BUFFER_LIMIT)
+        self._log_files[path] = f
+        if self._log_writer is None:
+            self._log_writer = _AsyncLogWriter()
+            atexit.register(self._close_logs)
+        return f
 
     def _append_log(self, path: Optional[Path], text: str):
+        """Queue a log line for the background writer; on disk once _close_logs() runs."""
         if not path:
             return
-        with open(path, "a", encoding="utf-8") as f:
-            f.write(text + "\n")
+        f = self._log_files.get(path) or self._open_log(path)
+        self._log_writer.write(f, text + "\n")
+
+    def _close_logs(self):
+        """Stop the writer thread and close all open log files; later writes reopen them."""
+        writer, self._log_writer = self._log_writer, None
+        if writer is not None:
+            writer.stop()
+            atexit.unregister(self._close_logs)
+        files, self._log_files = self._log_files, {}
+        for f in files.values():
+            try:
+                f.close()
+            except OSError as e:
+                print(f"⚠️  警告: 日志写入失败: {str(e)}")
 
     def _get_step_display_name(self, step_id: Optional[str]) -> str:
         """Return readable name for step_id if mapping available."""
         if not step_id:
             return "未知步骤"
-        mapping = getattr(self, "step_name_mapping", None)
-        if isinstance(mapping, dict):
-            return mapping.get(step_id, step_id)
-        return step_id
+        mapping = self.step_name_mapping
+        if mapping is not self._step_name_cache_source:
+            self._step_name_cache = {}
+            self._step_name_cache_source = mapping
+        name = self._step_name_cache.get(step_id)
+        if name is None:
+            name = mapping.get(step_id, step_id) if isinstance(mapping, dict) else step_id
+            self._step_name_cache[step_id] = name
+        return name
 
     def _log_run_card(self, step_id: str, payload: Dict[str, Any], response_data: Dict[str, Any]):
-        step_name = self._get_step_display_name(step_id)
         # 同时记录 step_name 和 step_id，便于阅读和回放
-        log_lines = [
-            f"Step: {step_name} | step_id: {step_id}",
-            f"请求载荷: {json.dumps(payload, ensure_ascii=False)}",
-            f"响应内容: {json.dumps(response_data, ensure_ascii=False)}",
-            "-" * 40,
-        ]
-        self._append_log(self.run_card_log_path, "\n".join(log_lines))
+        text = self.RUN_CARD_LOG_TEMPLATE.format(
+            timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            step_name=self._get_step_display_name(step_id),
+            step_id=step_id,
+            payload=_dumps(payload),
+            response=_dumps(response_data),
+        )
+        self._append_log(self.run_card_log_path, text)
 
     def _log_dialogue_entry(
         self,
@@ -176,19 +436,13 @@ class WorkflowTesterBase:
             lines.append(f"用户: {user_text}")
         if ai_text:
             lines.append(f"AI: {ai_text}")
-        lines.append("-" * 40)
+        lines.append(self.LOG_SEPARATOR)
         self._append_log(self.dialogue_log_path, "\n".join(lines))
 
-        if user_text and hasattr(self, "_collect_stage_data"):
-            try:
-                self._collect_stage_data(step_id, self.dialogue_round, "user", user_text)
-            except Exception:
-                pass
-        if ai_text and hasattr(self, "_collect_stage_data"):
-            try:
-                self._collect_stage_data(step_id, self.dialogue_round, "assistant", ai_text)
-            except Exception:
-                pass
+        try:
+            self._collect_stage_data_pair(step_id, self.dialogue_round, user_text, ai_text)
+        except Exception:
+            pass
 
     def _get_log_context_parts(self) -> List[str]:
         if not self.log_context_path:
@@ -198,10 +452,12 @@ class WorkflowTesterBase:
         if not isinstance(path, Path):
             path = Path(path)
 
-        try:
-            path = path.resolve()
-        except Exception:
-            pass
+        # _update_log_context stores resolved paths; only relative ones still need resolve()
+        if not path.is_absolute():
+            try:
+                path = path.resolve()
+            except Exception:
+                pass
 
         try:
             relative = path.relative_to(self.base_path)
@@ -229,10 +485,18 @@ class WorkflowTesterBase:
 
     def _determine_log_directory(self, task_id: str) -> Path:
         profile_key = self.student_profile_key or "unassigned"
+        key = (task_id, profile_key, self.log_context_path, self.log_root)
+        cached = self._log_dir_cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
         context_parts = self._get_log_context_parts()
         if context_parts:
-            return self.log_root.joinpath(*context_parts, profile_key)
-        return self.log_root / f"task_{task_id}" / profile_key
+            log_dir = self.log_root.joinpath(*context_parts, profile_key)
+        else:
+            log_dir = self.log_root / f"task_{task_id}" / profile_key
+        self._log_dir_cache = (key, log_dir)
+        return log_dir
 
     def _update_log_context(self, new_path: Any):
         if not new_path:
@@ -250,6 +514,14 @@ class WorkflowTesterBase:
     # ---- Profiles ----
     def _get_student_profile_info(self) -> Dict[str, Any]:
         key = self.student_profile_key or self.DEFAULT_PROFILE_KEY
+        cached = self._profile_info_cache
+        if cached is not None and cached[0] == key and cached[1] is self.student_profiles:
+            return cached[2]
+        info = self._resolve_student_profile_info(key)
+        self._profile_info_cache = (key, self.student_profiles, info)
+        return info
+
+    def _resolve_student_profile_info(self, key: Optional[str]) -> Dict[str, Any]:
         if key and key in self.student_profiles:
             return self.student_profiles[key]
         if self.DEFAULT_PROFILE_KEY and self.DEFAULT_PROFILE_KEY in self.student_profiles:
@@ -262,7 +534,7 @@ class WorkflowTesterBase:
 
         Returns: "txt" | "json" | "both"
         """
-        env_format = os.getenv("LOG_FORMAT", "").lower()
+        env_format = (_env("LOG_FORMAT") or "").lower()
         if env_format in ["txt", "json", "both"]:
             print(f"📋 使用环境变量设置的日志格式: {env_format.upper()}")
             return env_format
@@ -279,21 +551,35 @@ class WorkflowTesterBase:
         return selected_format
 
     def _collect_stage_data(self, step_id: str, round_num: int, role: str, content: str):
-        """Collect stage messages into self.json_stages."""
-        if not getattr(self, "json_log_enabled", False):
+        """Collect one stage message into self.json_stages."""
+        self._collect_stage_messages(step_id, round_num, [(role, content)])
+
+    def _collect_stage_data_pair(
+        self, step_id: str, round_num: int, user_text: Optional[str], ai_text: Optional[str]
+    ):
+        """Collect a user/assistant exchange (either side may be empty) with one stage lookup."""
+        messages = []
+        if user_text:
+            messages.append(("user", user_text))
+        if ai_text:
+            messages.append(("assistant", ai_text))
+        self._collect_stage_messages(step_id, round_num, messages)
+
+    def _collect_stage_messages(self, step_id: str, round_num: int, messages: List[Tuple[str, str]]):
+        if not messages or not self.json_log_enabled:
             return
 
-        if step_id not in self.json_stages:
-            stage_name = self.step_name_mapping.get(step_id, step_id)
-            self.json_stages[step_id] = {
+        stage = self.json_stages.get(step_id)
+        if stage is None:
+            stage = self.json_stages[step_id] = {
                 "stage_index": len(self.json_stages) + 1,
-                "stage_name": stage_name,
+                "stage_name": self.step_name_mapping.get(step_id, step_id),
                 "step_id": step_id,
                 "messages": [],
             }
 
-        self.json_stages[step_id]["messages"].append(
-            {"round": round_num, "role": role, "content": content}
+        stage["messages"].extend(
+            {"round": round_num, "role": role, "content": content} for role, content in messages
         )
 
     def _get_current_model_name(self) -> str:
@@ -302,6 +588,10 @@ class WorkflowTesterBase:
 
     def _build_json_structure(self) -> Dict[str, Any]:
         """Build the JSON dialogue structure."""
+        return {"metadata": self._build_json_metadata(), "stages": list(self.json_stages.values())}
+
+    def _build_json_metadata(self) -> Dict[str, Any]:
+        """Build the metadata block of the JSON log."""
         workflow_end_time = datetime.now()
         profile_info = self._get_student_profile_info()
 
@@ -333,16 +623,33 @@ class WorkflowTesterBase:
         if model_name is not None:
             metadata["model_name"] = model_name
 
-        return {"metadata": metadata, "stages": list(self.json_stages.values())}
+        return metadata
+
+    def _stream_json_log(self, f):
+        """Write the same bytes as _dumpb(_build_json_structure(), pretty=True), one stage at a time.
+
+        Each block is serialized on its own and re-indented to its nesting depth, so peak
+        memory is bounded by the largest stage instead of the whole conversation.
+        """
+        metadata = _dumpb(self._build_json_metadata(), pretty=True)
+        f.write(b'{\n  "metadata": ' + metadata.replace(b"\n", b"\n  ") + b',\n  "stages": ')
+        if not self.json_stages:
+            f.write(b"[]\n}")
+            return
+        sep = b"[\n    "
+        for stage in self.json_stages.values():
+            f.write(sep)
+            f.write(_dumpb(stage, pretty=True).replace(b"\n", b"\n    "))
+            sep = b",\n    "
+        f.write(b"\n  ]\n}")
 
     def _write_json_log(self):
         """Write JSON log to disk."""
-        if not getattr(self, "json_log_enabled", False) or not self.json_log_path:
+        if not self.json_log_enabled or not self.json_log_path:
             return
         try:
-            json_data = self._build_json_structure()
-            with open(self.json_log_path, "w", encoding="utf-8") as f:
-                json.dump(json_data, f, ensure_ascii=False, indent=2)
+            with open(self.json_log_path, "wb") as f:
+                self._stream_json_log(f)
             print(f"✅ JSON 日志已保存: {self.json_log_path}")
         except Exception as e:
             print(f"⚠️  警告: 保存 JSON 日志失败: {str(e)}")
@@ -359,18 +666,20 @@ class WorkflowTesterBase:
         """Interactive selection of student profiles. Returns selected keys."""
         title = self.PROFILE_SELECT_TITLE
         print(f"\n请选择{title}：")
-        options: Dict[str, str] = {}
+        # 编号 -> (档位 key, 显示名称)
+        options: Dict[str, Tuple[str, str]] = {}
         enabled_profiles = {
             k: v for k, v in self.student_profiles.items() if v.get("enabled", True)
         }
 
         for idx, (key, info) in enumerate(enabled_profiles.items(), 1):
-            options[str(idx)] = key
+            label = info.get("label", key)
+            options[str(idx)] = (key, label)
             desc = info.get("description", "")
-            print(f"{idx}. {info.get('label', key)} - {desc}")
+            print(f"{idx}. {label} - {desc}")
 
         default_choice = next(
-            (num for num, key in options.items() if key == self.DEFAULT_PROFILE_KEY),
+            (num for num, (key, _) in options.items() if key == self.DEFAULT_PROFILE_KEY),
             "1",
         )
 
@@ -387,25 +696,29 @@ class WorkflowTesterBase:
                 selections = [default_choice]
 
             if all(choice in options for choice in selections):
-                chosen_keys: List[str] = []
-                for choice in selections:
-                    mapped = options[choice]
-                    if mapped not in chosen_keys:
-                        chosen_keys.append(mapped)
+                # 去重并保持输入顺序
+                chosen = list(dict.fromkeys(options[choice] for choice in selections))
+                chosen_keys: List[str] = [key for key, _ in chosen]
 
                 if not allow_multi:
                     self.set_student_profile(chosen_keys[0])
                     return chosen_keys
 
-                labels = "，".join(
-                    self.student_profiles[key].get("label", key) for key in chosen_keys
-                )
+                labels = "，".join(label for _, label in chosen)
                 print(f"\n🎯 已选择 {len(chosen_keys)} 个{title}: {labels}")
                 return chosen_keys
 
             print("⚠️  无效选项，请重新输入。")
 
     # ---- Optional content loading ----
+    @staticmethod
+    def _read_text(path: Path) -> str:
+        """Read a UTF-8 text file in one binary read; newlines normalized like read_text()."""
+        text = path.read_bytes().decode("utf-8")
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        return text
+
     def load_student_dialogues(self, md_path: str) -> bool:
         """Load role example dialogues from a Markdown file."""
         try:
@@ -413,7 +726,7 @@ class WorkflowTesterBase:
             if not path.exists():
                 print(f"❌ 模拟对话文件不存在: {md_path}")
                 return False
-            self.dialogue_samples_content = path.read_text(encoding="utf-8")
+            self.dialogue_samples_content = self._read_text(path)
             print(
                 f"✅ 已加载模拟对话: {md_path} (大小: {len(self.dialogue_samples_content)} 字符)"
             )
@@ -436,7 +749,7 @@ class WorkflowTesterBase:
 
             if suffix == ".md":
                 # 直接读取 Markdown 文件
-                self.knowledge_base_content = path.read_text(encoding="utf-8")
+                self.knowledge_base_content = self._read_text(path)
             elif suffix == ".docx":
                 # 自动转换 docx 为 Markdown
                 try:
@@ -462,7 +775,7 @@ class WorkflowTesterBase:
                 return False
             else:
                 # 尝试作为文本文件读取
-                self.knowledge_base_content = path.read_text(encoding="utf-8")
+                self.knowledge_base_content = self._read_text(path)
 
             print(
                 f"✅ 知识库已加载: {kb_path} (大小: {len(self.knowledge_base_content)} 字符)"
@@ -481,8 +794,8 @@ class WorkflowTesterBase:
         print("=" * 60)
 
         print("\n1️⃣  检查环境变量:")
-        auth = os.getenv("AUTHORIZATION")
-        cookie = os.getenv("COOKIE")
+        auth = _env("AUTHORIZATION")
+        cookie = _env("COOKIE")
         if not auth and not cookie:
             print("❌ 错误: 未找到 AUTHORIZATION 或 COOKIE")
             return False
@@ -493,7 +806,7 @@ class WorkflowTesterBase:
 
         print("\n2️⃣  测试网络连接:")
         try:
-            response = requests.get(self.base_url, timeout=10)
+            response = self.session.get(self.base_url, timeout=10)
             print(f"✅ 服务器可访问 (状态码: {response.status_code})")
             return True
         except requests.exceptions.RequestException as e:
@@ -505,10 +818,10 @@ class WorkflowTesterBase:
         url = f"{self.base_url}/teacher-course/abilityTrain/queryScriptStepFlowList"
         payload = {"trainTaskId": task_id}
 
-        timeout = getattr(self, "base_timeout", 60)
+        timeout = self.base_timeout
         try:
             response = self._post_json(url, payload, timeout=timeout)
-            result = response.json()
+            result = self._response_json(response)
 
             if result.get("code") == 200 and result.get("success"):
                 data = result.get("data") or []
@@ -527,10 +840,15 @@ class WorkflowTesterBase:
         print(f"\n=== 获取步骤列表 ===")
         print(f"请求URL: {url}")
 
-        timeout = getattr(self, "base_timeout", 60)
+        # flowList 与步骤列表互不依赖，先在后台发出，与下面的请求并行
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=2)
+        flow_future = self._executor.submit(self._query_first_step_from_flow, task_id)
+
+        timeout = self.base_timeout
         try:
             response = self._post_json(url, payload, timeout=timeout)
-            result = response.json()
+            result = self._response_json(response)
 
             print(f"响应状态码: {response.status_code}")
 
@@ -541,6 +859,7 @@ class WorkflowTesterBase:
 
                 if isinstance(self.step_name_mapping, dict):
                     self.step_name_mapping.clear()
+                    self._step_name_cache.clear()
                     for step_item in data:
                         step_id = step_item.get("stepId")
                         step_detail = step_item.get("stepDetailDTO", {}) or {}
@@ -551,7 +870,7 @@ class WorkflowTesterBase:
                         print(f"✅ 已加载 {len(self.step_name_mapping)} 个步骤名称映射")
 
                 # 优先通过 flowList 接口获取正确的第一个步骤
-                first_step_id = self._query_first_step_from_flow(task_id)
+                first_step_id = flow_future.result()
 
                 # 回退逻辑：如果 flowList 失败，使用原有方式
                 if not first_step_id:
@@ -568,53 +887,56 @@ class WorkflowTesterBase:
             raise Exception("请求超时")
         except requests.exceptions.RequestException as e:
             raise Exception(f"网络请求失败: {str(e)}")
+        finally:
+            # 出错提前退出时不再等待 flowList；尚未开始的请求直接取消
+            flow_future.cancel()
 
     def run_card(self, task_id: str, step_id: str, session_id: Optional[str] = None) -> Dict[str, Any]:
-        """Run a workflow card."""
+        """Run a workflow card, following needSkipStep chains iteratively."""
         url = f"{self.base_url}/ai-tools/trainRun/runCard"
-        payload = {"taskId": task_id, "stepId": step_id, "sessionId": session_id}
-        if session_id:
-            payload["sessionId"] = session_id
+        timeout = self.base_timeout
 
-        print(f"\n=== 运行卡片 (stepId: {step_id}) ===")
-        print(f"请求URL: {url}")
-        print(f"请求载荷: {json.dumps(payload, indent=2, ensure_ascii=False)}")
+        while True:
+            payload = {"taskId": task_id, "stepId": step_id, "sessionId": session_id}
 
-        timeout = getattr(self, "base_timeout", 60)
-        try:
-            response = self._post_json(url, payload, timeout=timeout)
-            result = response.json()
+            print(f"\n=== 运行卡片 (stepId: {step_id}) ===")
+            print(f"请求URL: {url}")
+            if self.verbose:
+                print(f"请求载荷: {_dumps(payload, pretty=True)}")
+
+            try:
+                response = self._paced_post(url, payload, timeout=timeout)
+                result = self._response_json(response)
+            except requests.exceptions.Timeout:
+                raise Exception("请求超时")
+            except requests.exceptions.RequestException as e:
+                raise Exception(f"网络请求失败: {str(e)}")
             self._log_run_card(step_id, payload, result)
 
             print(f"响应状态码: {response.status_code}")
 
-            if result.get("code") == 200 and result.get("success"):
-                data = result.get("data") or {}
-                self.session_id = data.get("sessionId")
-                self.current_step_id = step_id
+            if not (result.get("code") == 200 and result.get("success")):
+                print("训练完成")
+                return result
 
-                self.question_text = data.get("text")
-                if self.question_text:
-                    print(f"\n📝 AI 说: {self.question_text}")
-                    self._log_dialogue_entry(step_id, ai_text=self.question_text, source="runCard")
+            data = result.get("data") or {}
+            self.session_id = data.get("sessionId")
+            self.current_step_id = step_id
 
-                # 处理交互轮数为0的情况：needSkipStep=true 时自动跳到下一步
-                need_skip = data.get("needSkipStep", False)
-                next_step_id = data.get("nextStepId")
-                if need_skip and next_step_id:
-                    print(f"\n⏭️  当前步骤无需交互，自动跳转到下一步骤: {next_step_id}")
-                    self.current_step_id = next_step_id
-                    return self.run_card(task_id, next_step_id, self.session_id)
+            self.question_text = data.get("text")
+            if self.question_text:
+                print(f"\n📝 AI 说: {self.question_text}")
+                self._log_dialogue_entry(step_id, ai_text=self.question_text, source="runCard")
 
+            # 处理交互轮数为0的情况：needSkipStep=true 时自动跳到下一步
+            need_skip = data.get("needSkipStep", False)
+            next_step_id = data.get("nextStepId")
+            if not (need_skip and next_step_id):
                 return result
 
-            print("训练完成")
-            return result
-
-        except requests.exceptions.Timeout:
-            raise Exception("请求超时")
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"网络请求失败: {str(e)}")
+            print(f"\n⏭️  当前步骤无需交互，自动跳转到下一步骤: {next_step_id}")
+            self.current_step_id = next_step_id
+            step_id, session_id = next_step_id, self.session_id
 
     def chat(self, user_input: str, step_id: Optional[str] = None) -> Dict[str, Any]:
         """Send user answer to the workflow."""
@@ -632,10 +954,10 @@ class WorkflowTesterBase:
         print(f"\n=== 发送用户回答 ===")
         print(f"👤 用户说: {user_input}")
 
-        timeout = getattr(self, "base_timeout", 60)
+        timeout = self.base_timeout
         try:
-            response = self._post_json(url, payload, timeout=timeout)
-            result = response.json()
+            response = self._paced_post(url, payload, timeout=timeout)
+            result = self._response_json(response)
 
             print(f"响应状态码: {response.status_code}")
 
@@ -687,45 +1009,57 @@ class WorkflowTesterBase:
 
     def _finalize_workflow(self):
         """Optional finalize hook (e.g., write JSON logs)."""
-        if hasattr(self, "_write_json_log") and getattr(self, "json_log_enabled", False):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+        self._close_logs()
+        if self.json_log_enabled:
             try:
                 self._write_json_log()
             except Exception as e:
                 print(f"⚠️  警告: JSON 日志写入失败: {str(e)}")
 
+    @contextlib.contextmanager
+    def _workflow_session(self, task_id: str):
+        """Start the workflow; logs are finalized on exit even when the body raises."""
+        try:
+            yield self.start_workflow(task_id)
+        finally:
+            try:
+                self._finalize_workflow()
+            except Exception as e:
+                print(f"⚠️  警告: 日志写入失败: {str(e)}")
+
     def run_interactive(self, task_id: str):
         """Run workflow interactively."""
         try:
-            self.start_workflow(task_id)
-            round_num = 1
-
-            while True:
-                if self.current_step_id is None:
-                    print("\n✅ 工作流完成！没有更多步骤了。")
-                    break
-
-                print("\n" + "=" * 60)
-                print(f"💬 第 {round_num} 轮对话")
-                print("=" * 60)
-
-                user_answer = input("请输入你的回答（输入 'quit' 退出）: ").strip()
-                if user_answer.lower() == "quit":
-                    print("👋 用户主动退出")
-                    break
-                if not user_answer:
-                    print("⚠️  回答不能为空，请重新输入")
-                    continue
-
-                result = self.chat(user_answer)
-                data = result.get("data") or {}
-                if data.get("nextStepId") is None:
-                    print("\n✅ 工作流完成！")
-                    break
-
-                round_num += 1
-                time.sleep(0.5)
-
-            self._finalize_workflow()
+            with self._workflow_session(task_id):
+                round_num = 1
+
+                while True:
+                    if self.current_step_id is None:
+                        print("\n✅ 工作流完成！没有更多步骤了。")
+                        break
+
+                    print("\n" + "=" * 60)
+                    print(f"💬 第 {round_num} 轮对话")
+                    print("=" * 60)
+
+                    user_answer = input("请输入你的回答（输入 'quit' 退出）: ").strip()
+                    if user_answer.lower() == "quit":
+                        print("👋 用户主动退出")
+                        break
+                    if not user_answer:
+                        print("⚠️  回答不能为空，请重新输入")
+                        continue
+
+                    result = self.chat(user_answer)
+                    data = result.get("data") or {}
+                    if data.get("nextStepId") is None:
+                        print("\n✅ 工作流完成！")
+                        break
+
+                    round_num += 1
 
         except Exception as e:
             print(f"\n❌ 错误: {str(e)}")
@@ -736,23 +1070,19 @@ class WorkflowTesterBase:
     def run_auto(self, task_id: str, user_answers: List[str]):
         """Run workflow using preset answers."""
         try:
-            self.start_workflow(task_id)
-
-            for i, answer in enumerate(user_answers, 1):
-                if self.current_step_id is None:
-                    print("\n✅ 工作流已结束")
-                    break
-
-                print(f"\n--- 第 {i} 轮对话 ---")
-                time.sleep(1)
-
-                result = self.chat(answer)
-                data = result.get("data") or {}
-                if data.get("nextStepId") is None:
-                    print("\n✅ 工作流完成！")
-                    break
-
-            self._finalize_workflow()
+            with self._workflow_session(task_id):
+                for i, answer in enumerate(user_answers, 1):
+                    if self.current_step_id is None:
+                        print("\n✅ 工作流已结束")
+                        break
+
+                    print(f"\n--- 第 {i} 轮对话 ---")
+
+                    result = self.chat(answer)
+                    data = result.get("data") or {}
+                    if data.get("nextStepId") is None:
+                        print("\n✅ 工作流完成！")
+                        break
 
             print("\n" + "=" * 60)
             print("🎉 工作流测试结束")